@@ -0,0 +1,100 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''Benchmark of the event decoding path.
+
+Compares the former decoding of a message (UTF-8 decoding of the message,
+json.loads, full base64 decoding of the body and logging the whole event)
+with the Event class (parsing the message bytes, with orjson if installed,
+decoding the body once and logging a truncated preview) for several payload
+sizes. It reports the decoding time and the peak memory allocated while
+decoding, measured with tracemalloc.
+
+Usage: python benchmarks/bench_decode.py [-n 50]'''
+
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import oscarworker.event as event_module
+from oscarworker.event import Event
+
+PREVIEW_BYTES = 256
+
+
+def create_message(payload_size):
+    return json.dumps({
+        'Function': 'cowsay',
+        'Host': 'gateway.openfaas:8080',
+        'Path': '/async-function/cowsay',
+        'Header': {'Content-Type': ['text/plain'], 'X-Call-Id': ['0f8fad5b-d9cb-469f-a165-70867728950e']},
+        'Body': base64.b64encode(b'x' * payload_size).decode('ascii')
+    }).encode('utf-8')
+
+
+def legacy_decode(message):
+    data = json.loads(message.decode('utf-8'))
+    event = base64.b64decode(data['Body']).decode('utf-8')
+    logging.info('EVENT RECEIVED: {0}'.format(event))
+    return str(event)
+
+
+def event_decode(message):
+    data = Event.from_message(message)
+    event = data.text
+    logging.info('EVENT RECEIVED: {0}'.format(data.preview(PREVIEW_BYTES)))
+    return event
+
+
+def measure(decode, message, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(message)
+    elapsed = (time.perf_counter() - start) / iterations
+    tracemalloc.start()
+    decode(message)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('--payload-sizes', type=int, nargs='+', default=[1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024])
+    args = parser.parse_args()
+
+    # Log records are formatted as in the worker, but discarded
+    logging.basicConfig(level=logging.INFO, stream=open(os.devnull, 'w'))
+
+    print('JSON backend: {0}'.format('orjson' if event_module.orjson is not None else 'json'))
+    print('{0:>9} {1:>12} {2:>12} {3:>14} {4:>14}'.format(
+        'payload', 'legacy ms', 'event ms', 'legacy peak MB', 'event peak MB'))
+    for payload_size in args.payload_sizes:
+        message = create_message(payload_size)
+        legacy_time, legacy_peak = measure(legacy_decode, message, args.iterations)
+        event_time, event_peak = measure(event_decode, message, args.iterations)
+        print('{0:>9} {1:>12.3f} {2:>12.3f} {3:>14.2f} {4:>14.2f}'.format(
+            payload_size, legacy_time * 1000, event_time * 1000, legacy_peak / 2 ** 20, event_peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Micro-benchmark of the per-event cost of building a serialized Job.
+
+Compares the former code path (rebuild the Job dict from the deployment and
+serialize it) with rendering a precompiled JobTemplate.
+
+Usage: python benchmarks/bench_job_template.py [-n ITERATIONS]'''
+
+import argparse
+import copy
+import json
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from oscarworker.jobtemplate import JobTemplate
+
+DEPLOYMENT = {
+    'metadata': {'name': 'cowsay', 'resourceVersion': '1234'},
+    'spec': {
+        'template': {
+            'spec': {
+                'containers': [
+                    {
+                        'name': 'cowsay',
+                        'image': 'grycap/cowsay:latest',
+                        'env': [
+                            {'name': 'fprocess', 'value': 'python3 /handler.py'},
+                            {'name': 'read_timeout', 'value': '300s'},
+                            {'name': 'write_timeout', 'value': '300s'},
+                            {'name': 'SECRET', 'valueFrom': {'secretKeyRef': {'name': 'cowsay', 'key': 'token'}}}
+                        ],
+                        'volumeMounts': [{'name': 'secrets', 'mountPath': '/var/openfaas/secrets', 'readOnly': True}]
+                    }
+                ],
+                'volumes': [{'name': 'secrets', 'projected': {'sources': [{'secret': {'name': 'cowsay'}}]}}]
+            }
+        }
+    }
+}
+
+ENVS = [
+    {'name': 'Http_Host', 'value': 'gateway.openfaas:8080'},
+    {'name': 'Http_Path', 'value': '/async-function/cowsay'},
+    {'name': 'Http_Content_Type', 'value': 'application/json'},
+    {'name': 'Http_X_Call_Id', 'value': '0f8fad5b-d9cb-469f-a165-70867728950e'}
+]
+
+
+def legacy_job_definition(deployment_info, function_name, event, envs):
+    # Former KubernetesClient._create_job_definition body (without the API calls)
+    container_info = deployment_info['spec']['template']['spec']['containers'][0]
+    pod_spec = deployment_info['spec']['template']['spec']
+    if 'volumes' in pod_spec:
+        volumes = pod_spec['volumes']
+    else:
+        volumes = []
+    if 'resources' in container_info and bool(container_info['resources']):
+        resources = container_info['resources']
+    else:
+        resources = {
+            'requests': {'memory': '256Mi', 'cpu': '250m'},
+            'limits': {'memory': '256Mi', 'cpu': '250m'}
+        }
+    job = {
+        'apiVersion': 'batch/v1',
+        'kind': 'Job',
+        'metadata': {
+            'name': '{0}-{1}'.format(function_name, str(uuid.uuid4())),
+            'namespace': 'oscar-fn',
+        },
+        'spec': {
+            'backoffLimit': 6,
+            'template': {
+                'spec': {
+                    'containers': [
+                        {
+                            'name': container_info['name'],
+                            'image': container_info['image'],
+                            'command': ['/bin/sh'],
+                            'args': ['-c', 'echo $EVENT | $fprocess'],
+                            'env': list(container_info['env']) if 'env' in container_info else [],
+                            'resources': resources,
+                            'volumeMounts': container_info['volumeMounts'] if 'volumeMounts' in container_info else []
+                        }
+                    ],
+                    'volumes': volumes,
+                    'restartPolicy': 'OnFailure'
+                }
+            }
+        }
+    }
+    job['spec']['template']['spec']['containers'][0]['env'].append({'name': 'EVENT', 'value': str(event)})
+    job['spec']['template']['spec']['containers'][0]['env'].extend(envs)
+    job['spec']['ttlSecondsAfterFinished'] = 60
+    return json.dumps(job).encode('utf-8')
+
+
+def template_job_definition(template, function_name, event, envs):
+    name = '{0}-{1}'.format(function_name, str(uuid.uuid4()))
+    return template.render(name, [{'name': 'EVENT', 'value': event}] + envs, bucket='0')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    template = JobTemplate.from_deployment(DEPLOYMENT, 'oscar-fn', 6, 60)
+
+    # Both paths must produce the same Job (besides the random name)
+    legacy = json.loads(legacy_job_definition(copy.deepcopy(DEPLOYMENT), 'cowsay', 'hello', ENVS))
+    compiled = json.loads(template_job_definition(template, 'cowsay', 'hello', ENVS))
+    legacy['metadata']['name'] = compiled['metadata']['name']
+    legacy['metadata']['labels'] = compiled['metadata']['labels']
+    legacy['spec']['template']['metadata'] = compiled['spec']['template']['metadata']
+    assert legacy == compiled, 'Rendered Job differs from the legacy definition'
+
+    print('{0:>10} {1:>14} {2:>14} {3:>8}'.format('event', 'legacy (us)', 'template (us)', 'speedup'))
+    for size in (16, 1024, 64 * 1024):
+        event = 'x' * size
+        legacy_time = timeit.timeit(lambda: legacy_job_definition(DEPLOYMENT, 'cowsay', event, ENVS),
+                                    number=args.iterations)
+        template_time = timeit.timeit(lambda: template_job_definition(template, 'cowsay', event, ENVS),
+                                      number=args.iterations)
+        print('{0:>10} {1:>14.2f} {2:>14.2f} {3:>7.2f}x'.format(
+            size,
+            legacy_time / args.iterations * 1e6,
+            template_time / args.iterations * 1e6,
+            legacy_time / template_time))
+
+
+if __name__ == '__main__':
+    main()
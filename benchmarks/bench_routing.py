@@ -0,0 +1,142 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Routing benchmark of the multi-target Job dispatch.
+
+Starts one stub Kubernetes API (fakekube.py) per target, each with its own
+latency and error rate and with Jobs completing after --job-duration
+seconds, and launches the events through KubernetesClient with each
+routing policy. Halfway through, the target selected with --fail-target is
+stopped to exercise the failover. It reports events/sec, p50/p99 launch
+latency, failed events and the Jobs created in each target.
+
+Usage: python benchmarks/bench_routing.py [--latencies 2 10 30] [--fail-target 2]'''
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakekube
+
+FUNCTION_NAME = 'cowsay'
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def create_event():
+    return {'Function': FUNCTION_NAME, 'Header': {}, 'Body': base64.b64encode(b'x' * 256).decode('utf-8')}
+
+
+async def run_policy(args, policy):
+    from oscarworker.kubernetesclient import KubernetesClient
+    servers = []
+    for index, latency in enumerate(args.latencies):
+        error_rate = args.error_rates[index] if index < len(args.error_rates) else 0.0
+        server = fakekube.FakeKubernetes(latency=latency / 1000, error_rate=error_rate,
+                                         functions=(FUNCTION_NAME,), job_duration=args.job_duration)
+        await server.start(args.port + index)
+        servers.append(server)
+    os.environ['KUBERNETES_TARGETS'] = json.dumps([
+        {'name': 'target-{0}'.format(index), 'port': str(args.port + index)} for index in range(len(servers))])
+    os.environ['ROUTING_POLICY'] = policy
+
+    kube_client = KubernetesClient()
+    await kube_client.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = [0]
+
+    async def process():
+        start = time.perf_counter()
+        try:
+            if not await kube_client.launch_job(create_event()):
+                failures[0] += 1
+            latencies.append(time.perf_counter() - start)
+        finally:
+            semaphore.release()
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(args.events):
+        if args.fail_target is not None and i == args.events // 2:
+            await servers[args.fail_target].close()
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(process()))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    await kube_client.close()
+    for index, server in enumerate(servers):
+        if index != args.fail_target:
+            await server.close()
+    return {
+        'policy': policy,
+        'events_per_second': args.events / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'failures': failures[0],
+        'jobs': [len(server.jobs) for server in servers]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--events', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latencies', type=float, nargs='+', default=[2, 10, 30],
+                        help='API latency of each target in milliseconds')
+    parser.add_argument('--error-rates', type=float, nargs='+', default=[],
+                        help='Ratio of 503 responses of each target')
+    parser.add_argument('--job-duration', type=float, default=1.0, help='Seconds until Jobs complete')
+    parser.add_argument('--fail-target', type=int, help='Target stopped halfway through')
+    parser.add_argument('--policies', nargs='+', default=['least-loaded', 'weighted'])
+    parser.add_argument('--port', type=int, default=18101)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    os.environ.update({
+        'KUBE_TOKEN': 'benchmark',
+        'KUBERNETES_SERVICE_SCHEME': 'http',
+        'KUBERNETES_SERVICE_HOST': '127.0.0.1',
+        # Fail over quickly instead of retrying the stopped target
+        'KUBE_MAX_RETRIES': '1',
+        'TARGET_HEALTH_INTERVAL': '1'
+    })
+    loop = asyncio.get_event_loop()
+    results = [loop.run_until_complete(run_policy(args, policy)) for policy in args.policies]
+
+    print('{0:>13} {1:>10} {2:>9} {3:>9} {4:>8}  {5}'.format('policy', 'events/s', 'p50 ms', 'p99 ms', 'failed',
+                                                             'jobs per target'))
+    for r in results:
+        print('{0:>13} {1:>10.1f} {2:>9.2f} {3:>9.2f} {4:>8}  {5}'.format(
+            r['policy'], r['events_per_second'], r['p50_ms'], r['p99_ms'], r['failures'],
+            ' '.join(str(jobs) for jobs in r['jobs'])))
+
+
+if __name__ == '__main__':
+    main()
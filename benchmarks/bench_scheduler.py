@@ -0,0 +1,90 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''Fairness benchmark of the per-function scheduler.
+
+A burst of events of a hot function arrives together with a steady trickle
+of events of small functions. Launches are simulated with a fixed latency
+and bounded concurrency, first in arrival order (FIFO, as without the
+scheduler) and then through the FairScheduler. It reports the p50/p99 time
+from arrival to launch of each kind of function.
+
+Usage: python benchmarks/bench_scheduler.py [--burst 5000] [--launch-latency 20]'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from oscarworker.scheduler import FairScheduler
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run_scenario(args, fair):
+    latencies = {'hot': [], 'small': []}
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def launch(data):
+        await asyncio.sleep(args.launch_latency / 1000)
+        return True
+
+    if fair:
+        scheduler = FairScheduler(launch, args.concurrency, lambda function_name: (1.0, 0))
+        submit = scheduler.submit
+    else:
+        async def submit(data):
+            async with slots:
+                return await launch(data)
+
+    async def event(function_name, kind):
+        start = time.perf_counter()
+        await submit({'Function': function_name})
+        latencies[kind].append(time.perf_counter() - start - args.launch_latency / 1000)
+
+    tasks = [asyncio.ensure_future(event('hot', 'hot')) for _ in range(args.burst)]
+    for i in range(args.small_events):
+        tasks.append(asyncio.ensure_future(event('small-{0}'.format(i % args.small_functions), 'small')))
+        await asyncio.sleep(args.small_interval / 1000)
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--burst', type=int, default=5000, help='Events of the hot function')
+    parser.add_argument('--small-functions', type=int, default=10)
+    parser.add_argument('--small-events', type=int, default=200)
+    parser.add_argument('--small-interval', type=float, default=5, help='Milliseconds between small events')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--launch-latency', type=float, default=20, help='Milliseconds per launch')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    print('{0:>6} {1:>6} {2:>9} {3:>9}'.format('mode', 'kind', 'p50 ms', 'p99 ms'))
+    for mode, fair in (('fifo', False), ('drr', True)):
+        latencies = loop.run_until_complete(run_scenario(args, fair))
+        for kind in ('hot', 'small'):
+            print('{0:>6} {1:>6} {2:>9.2f} {3:>9.2f}'.format(mode, kind, percentile(latencies[kind], 0.5) * 1000,
+                                                           percentile(latencies[kind], 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Offline throughput benchmark of the worker event path.
+
+Starts the stub Kubernetes API (fakekube.py) in a separate process and
+feeds locally generated messages through the same steps as the subscriber
+callback (JSON decoding and KubernetesClient.launch_job) with bounded
+concurrency, or pulls them in batches through the local subscriber backend
+(--batch-size). For each payload size and concurrency level it reports
+events/sec, p50/p99 event-to-POST latency, CPU time and peak RSS.
+
+Usage:
+    python benchmarks/bench_throughput.py --save baseline.json
+    python benchmarks/bench_throughput.py --baseline baseline.json'''
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakekube
+
+FUNCTION_NAME = 'cowsay'
+
+
+def run_server(port, args, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(fakekube.from_arguments(args, (FUNCTION_NAME,)).start(port))
+    ready.set()
+    loop.run_forever()
+
+
+def create_message(payload_size):
+    envelope = {
+        'Function': FUNCTION_NAME,
+        'Host': 'gateway.openfaas:8080',
+        'Path': '/async-function/{0}'.format(FUNCTION_NAME),
+        'Header': {'Content-Type': ['text/plain'], 'X-Call-Id': ['0f8fad5b-d9cb-469f-a165-70867728950e']},
+        'Body': base64.b64encode(b'x' * payload_size).decode('utf-8')
+    }
+    return json.dumps(envelope).encode('utf-8')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def pull_events(kube_client, message, concurrency, events, batch_size, latencies, failures):
+    # Same events through the local subscriber backend, fetched in batches
+    from oscarworker.subscribers.local import LocalSubscriber
+    subscriber = LocalSubscriber()
+    subscriber.max_concurrency = concurrency
+    subscriber.batch_size = batch_size
+    subscriber.fetch_timeout = 0.01
+    finished = asyncio.Event()
+
+    async def batch_handler(batch):
+        received = time.perf_counter()
+        results = await kube_client.launch_jobs(batch)
+        for result in results:
+            if result:
+                latencies.append(time.perf_counter() - received)
+            else:
+                failures[0] += 1
+        if len(latencies) + failures[0] >= events:
+            finished.set()
+        # Failed events are not redelivered
+        return [True] * len(results)
+
+    for _ in range(events):
+        subscriber.publish(message)
+    task = await subscriber.run(None, None, batch_handler)
+    await finished.wait()
+    task.cancel()
+
+
+async def run_scenario(kube_client, payload_size, concurrency, events, batch_size=None):
+    message = create_message(payload_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = [0]
+
+    async def process(received):
+        try:
+            data = json.loads(message.decode('utf-8'))
+            if not await kube_client.launch_job(data):
+                failures[0] += 1
+            latencies.append(time.perf_counter() - received)
+        except Exception:
+            failures[0] += 1
+        finally:
+            semaphore.release()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    if batch_size:
+        await pull_events(kube_client, message, concurrency, events, batch_size, latencies, failures)
+    else:
+        tasks = []
+        for _ in range(events):
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(process(time.perf_counter())))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+
+    return {
+        'payload_size': payload_size,
+        'concurrency': concurrency,
+        'events': events,
+        'failures': failures[0],
+        'events_per_second': events / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_ms_per_event': cpu / events * 1000,
+        # ru_maxrss is reported in KiB on Linux
+        'max_rss_mb': end_usage.ru_maxrss / 1024
+    }
+
+
+async def run_benchmark(args):
+    from oscarworker.kubernetesclient import KubernetesClient
+    kube_client = KubernetesClient()
+    await kube_client.start()
+    results = []
+    try:
+        for payload_size in args.payload_sizes:
+            for concurrency in args.concurrency:
+                # Warm up connections and caches
+                await run_scenario(kube_client, payload_size, concurrency, min(args.events, concurrency * 2),
+                                   args.batch_size)
+                results.append(await run_scenario(kube_client, payload_size, concurrency, args.events,
+                                                  args.batch_size))
+    finally:
+        await kube_client.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Returns the list of regressions of 'results' against 'baseline\''''
+    previous = {(r['payload_size'], r['concurrency']): r for r in baseline}
+    regressions = []
+    for result in results:
+        reference = previous.get((result['payload_size'], result['concurrency']))
+        if not reference:
+            continue
+        if result['events_per_second'] < reference['events_per_second'] * (1 - tolerance):
+            regressions.append((result, 'events_per_second', reference['events_per_second']))
+        for key in ('p99_ms', 'cpu_ms_per_event'):
+            if result[key] > reference[key] * (1 + tolerance):
+                regressions.append((result, key, reference[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--events', type=int, default=2000, help='Events per scenario')
+    parser.add_argument('--payload-sizes', type=int, nargs='+', default=[256, 16 * 1024, 256 * 1024])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--batch-size', type=int,
+                        help='Pull the events in batches of this size through the local subscriber')
+    parser.add_argument('--port', type=int, default=18001)
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative regression')
+    fakekube.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server, args=(args.port, args, ready), daemon=True)
+    server.start()
+    ready.wait()
+
+    os.environ.update({
+        'KUBE_TOKEN': 'benchmark',
+        'KUBERNETES_SERVICE_SCHEME': 'http',
+        'KUBERNETES_SERVICE_HOST': '127.0.0.1',
+        'KUBERNETES_SERVICE_PORT': str(args.port)
+    })
+    try:
+        results = asyncio.get_event_loop().run_until_complete(run_benchmark(args))
+    finally:
+        server.terminate()
+
+    print('{0:>9} {1:>6} {2:>10} {3:>9} {4:>9} {5:>11} {6:>9} {7:>8}'.format(
+        'payload', 'conc', 'events/s', 'p50 ms', 'p99 ms', 'cpu ms/ev', 'rss MB', 'failed'))
+    for r in results:
+        print('{0:>9} {1:>6} {2:>10.1f} {3:>9.2f} {4:>9.2f} {5:>11.3f} {6:>9.1f} {7:>8}'.format(
+            r['payload_size'], r['concurrency'], r['events_per_second'], r['p50_ms'], r['p99_ms'],
+            r['cpu_ms_per_event'], r['max_rss_mb'], r['failures']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, key, reference in regressions:
+            print('REGRESSION payload={0} concurrency={1}: {2} {3:.3f} (baseline {4:.3f})'.format(
+                result['payload_size'], result['concurrency'], key, result[key], reference))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''In-process stub of the Kubernetes API endpoints used by the worker.
+
+It serves function deployments, nodes, pods, Jobs and ConfigMaps from
+memory, with configurable latency and rates of throttled (429) and failed
+(5xx) responses. Watches stream the changes of the objects, and Jobs can
+be completed after a fixed duration.
+
+Usage: python benchmarks/fakekube.py [--port 8001] [--latency 5] [--throttle-rate 0.01]'''
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import uuid
+from aiohttp import web
+
+FUNCTIONS_NAMESPACE = 'openfaas-fn'
+
+
+def create_deployment(name, resource_version='1', annotations=None):
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {
+            'name': name,
+            'namespace': FUNCTIONS_NAMESPACE,
+            'resourceVersion': resource_version,
+            'annotations': annotations or {}
+        },
+        'spec': {
+            'template': {
+                'spec': {
+                    'containers': [
+                        {
+                            'name': name,
+                            'image': 'grycap/{0}:latest'.format(name),
+                            'env': [{'name': 'fprocess', 'value': 'cat'}]
+                        }
+                    ]
+                }
+            }
+        }
+    }
+
+
+def create_node(name, version, cpu='8', memory='32Gi'):
+    return {
+        'metadata': {'name': name, 'resourceVersion': '1'},
+        'spec': {},
+        'status': {
+            'allocatable': {'cpu': cpu, 'memory': memory},
+            'conditions': [{'type': 'Ready', 'status': 'True'}],
+            'nodeInfo': {'kubeletVersion': version}
+        }
+    }
+
+
+def match_labels(obj, selector):
+    if not selector:
+        return True
+    labels = obj['metadata'].get('labels') or {}
+    for requirement in selector.split(','):
+        if '=' in requirement:
+            key, value = requirement.split('=', 1)
+            if labels.get(key) != value:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+def match_fields(obj, selector):
+    # Only equality on the Job 'status.successful' field is supported
+    if not selector:
+        return True
+    for requirement in selector.split(','):
+        key, value = requirement.split('=', 1)
+        if key == 'status.successful' and str(obj.get('status', {}).get('succeeded', 0)) != value:
+            return False
+    return True
+
+
+class FakeKubernetes:
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, retry_after=1,
+                 functions=('cowsay',), version='v1.25.0', nodes=1, job_duration=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.version = version
+        self.deployments = {name: create_deployment(name) for name in functions}
+        self.nodes = {'node-{0}'.format(i): create_node('node-{0}'.format(i), version) for i in range(nodes)}
+        self.pods = {}
+        self.jobs = {}
+        self.config_maps = {}
+        self.requests = collections.Counter()
+        self.resource_version = 1
+        # Seconds until created Jobs complete (never if 0)
+        self.job_duration = job_duration
+        # id(objects) -> [(label selector, queue of events)]
+        self._watchers = collections.defaultdict(list)
+
+    def _next_resource_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.requests[(request.method, request.path)] += 1
+        if 'watch' in request.query:
+            return await handler(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        draw = random.random()
+        if draw < self.throttle_rate:
+            return self._status(429, 'TooManyRequests', 'Too many requests, please try again later.',
+                                headers={'Retry-After': str(self.retry_after)})
+        if draw < self.throttle_rate + self.error_rate:
+            return self._status(503, 'ServiceUnavailable', 'The server is currently unable to handle the request')
+        return await handler(request)
+
+    def _status(self, code, reason, message, headers=None):
+        body = {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                'reason': reason, 'message': message, 'code': code}
+        return web.json_response(body, status=code, headers=headers)
+
+    def _list(self, request, objects):
+        selector = request.query.get('labelSelector')
+        items = [obj for obj in objects.values() if match_labels(obj, selector)]
+        return web.json_response({'metadata': {'resourceVersion': str(self.resource_version)}, 'items': items})
+
+    def _notify(self, objects, event_type, obj):
+        for selector, queue in self._watchers[id(objects)]:
+            if match_labels(obj, selector):
+                queue.put_nowait({'type': event_type, 'object': obj})
+
+    async def _watch(self, request, objects):
+        # Stream the changes of the objects until the watch times out
+        response = web.StreamResponse()
+        await response.prepare(request)
+        watcher = (request.query.get('labelSelector'), asyncio.Queue())
+        self._watchers[id(objects)].append(watcher)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + int(request.query.get('timeoutSeconds', 300))
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(watcher[1].get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    # The server is closing
+                    break
+                await response.write(json.dumps(event).encode('utf-8') + b'\n')
+        finally:
+            self._watchers[id(objects)].remove(watcher)
+        return response
+
+    def _collection(self, objects):
+        async def handler(request):
+            if 'watch' in request.query:
+                return await self._watch(request, objects)
+            return self._list(request, objects)
+        return handler
+
+    def _get(self, objects, kind):
+        async def handler(request):
+            obj = objects.get(request.match_info['name'])
+            if not obj:
+                return self._status(404, 'NotFound', '{0} "{1}" not found'.format(kind, request.match_info['name']))
+            return web.json_response(obj)
+        return handler
+
+    def _create(self, objects, kind):
+        async def handler(request):
+            obj = json.loads(await request.read())
+            name = obj['metadata']['name']
+            namespace = request.match_info.get('namespace')
+            if obj['metadata'].get('namespace', namespace) != namespace:
+                return self._status(400, 'BadRequest', 'the namespace of the provided object does not match '
+                                                       'the namespace sent on the request')
+            if name in objects:
+                return self._status(409, 'AlreadyExists', '{0} "{1}" already exists'.format(kind, name))
+            obj['metadata']['uid'] = str(uuid.uuid4())
+            obj['metadata']['resourceVersion'] = self._next_resource_version()
+            objects[name] = obj
+            self._notify(objects, 'ADDED', obj)
+            if objects is self.jobs and self.job_duration:
+                asyncio.get_event_loop().call_later(self.job_duration, self._complete_job, name)
+            return web.json_response(obj, status=201)
+        return handler
+
+    def _complete_job(self, name):
+        job = self.jobs.get(name)
+        if job:
+            job['status'] = {'succeeded': 1, 'conditions': [{'type': 'Complete', 'status': 'True'}]}
+            job['metadata']['resourceVersion'] = self._next_resource_version()
+            self._notify(self.jobs, 'MODIFIED', job)
+
+    async def _create_pod(self, request):
+        # Pods start running and ready at once
+        response = await self._create(self.pods, 'pods')(request)
+        if response.status == 201:
+            pod = json.loads(response.body)
+            pod['status'] = {'phase': 'Running', 'podIP': '127.0.0.1',
+                             'conditions': [{'type': 'Ready', 'status': 'True'}]}
+            self.pods[pod['metadata']['name']] = pod
+            self._notify(self.pods, 'MODIFIED', pod)
+            return web.json_response(pod, status=201)
+        return response
+
+    def _delete(self, objects, kind):
+        async def handler(request):
+            obj = objects.pop(request.match_info['name'], None)
+            if not obj:
+                return self._status(404, 'NotFound', '{0} "{1}" not found'.format(kind, request.match_info['name']))
+            self._notify(objects, 'DELETED', obj)
+            return web.json_response(obj)
+        return handler
+
+    def _delete_collection(self, objects):
+        async def handler(request):
+            selector = request.query.get('labelSelector')
+            field_selector = request.query.get('fieldSelector')
+            deleted = [name for name, obj in objects.items()
+                       if match_labels(obj, selector) and match_fields(obj, field_selector)]
+            for name in deleted:
+                self._notify(objects, 'DELETED', objects.pop(name))
+            return web.json_response({'kind': 'Status', 'status': 'Success', 'details': {'deleted': len(deleted)}})
+        return handler
+
+    async def _get_version(self, request):
+        return web.json_response({'major': '1', 'minor': self.version.split('.')[1], 'gitVersion': self.version})
+
+    def create_app(self):
+        app = web.Application(middlewares=[self._middleware])
+        deployments = '/apis/apps/v1/namespaces/{0}/deployments'.format(FUNCTIONS_NAMESPACE)
+        # Every namespace shares the same objects
+        jobs = '/apis/batch/v1/namespaces/{namespace}/jobs'
+        config_maps = '/api/v1/namespaces/{namespace}/configmaps'
+        app.router.add_get('/version', self._get_version)
+        app.router.add_get(deployments, self._collection(self.deployments))
+        app.router.add_get(deployments + '/{name}', self._get(self.deployments, 'deployments.apps'))
+        app.router.add_get('/api/v1/nodes', self._collection(self.nodes))
+        app.router.add_get('/api/v1/pods', self._collection(self.pods))
+        pods = '/api/v1/namespaces/{namespace}/pods'
+        app.router.add_get(pods, self._collection(self.pods))
+        app.router.add_post(pods, self._create_pod)
+        app.router.add_delete(pods + '/{name}', self._delete(self.pods, 'pods'))
+        app.router.add_get(jobs, self._collection(self.jobs))
+        app.router.add_post(jobs, self._create(self.jobs, 'jobs.batch'))
+        app.router.add_delete(jobs, self._delete_collection(self.jobs))
+        app.router.add_get(jobs + '/{name}', self._get(self.jobs, 'jobs.batch'))
+        app.router.add_delete(jobs + '/{name}', self._delete(self.jobs, 'jobs.batch'))
+        app.router.add_post(config_maps, self._create(self.config_maps, 'configmaps'))
+        return app
+
+    async def start(self, port, host='127.0.0.1'):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self):
+        for watchers in self._watchers.values():
+            for _, queue in watchers:
+                queue.put_nowait(None)
+        await self._runner.cleanup()
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help='API latency in milliseconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Ratio of 429 responses')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Ratio of 503 responses')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of 429 responses (seconds)')
+    parser.add_argument('--kubernetes-version', default='v1.25.0')
+    parser.add_argument('--job-duration', type=float, default=0.0,
+                        help='Seconds until created Jobs complete (never if 0)')
+
+
+def from_arguments(args, functions=('cowsay',)):
+    return FakeKubernetes(latency=args.latency / 1000, throttle_rate=args.throttle_rate,
+                          error_rate=args.error_rate, retry_after=args.retry_after,
+                          functions=functions, version=args.kubernetes_version,
+                          job_duration=args.job_duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(from_arguments(args).create_app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
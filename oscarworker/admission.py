@@ -0,0 +1,225 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import time
+import oscarworker.metrics as metrics
+import oscarworker.utils as utils
+
+
+def get_pod_requests(pod_spec):
+    '''Returns the (cpu, memory) requested by the containers of a pod'''
+    cpu = 0.0
+    memory = 0.0
+    for container in pod_spec.get('containers', []):
+        resources = container.get('resources') or {}
+        # Kubernetes defaults requests to limits when only limits are set
+        requests = resources.get('requests') or resources.get('limits') or {}
+        if 'cpu' in requests:
+            cpu += utils.parse_quantity(requests['cpu'])
+        if 'memory' in requests:
+            memory += utils.parse_quantity(requests['memory'])
+    return cpu, memory
+
+
+def is_node_schedulable(node):
+    if node['spec'].get('unschedulable'):
+        return False
+    for taint in node['spec'].get('taints') or []:
+        if taint.get('effect') in ('NoSchedule', 'NoExecute'):
+            return False
+    for condition in node['status'].get('conditions') or []:
+        if condition['type'] == 'Ready':
+            return condition['status'] == 'True'
+    return False
+
+
+class AdmissionController:
+    '''Holds Job submissions in a local queue until the cluster has enough
+    allocatable CPU and memory for the resources they request.
+
+    Capacity comes from node and pod watches. Jobs admitted but whose pod has
+    not been observed yet are kept as reservations so bursts are not
+    admitted twice against the same free capacity.'''
+
+    policies = ('fifo', 'fair')
+    reservation_timeout = 60
+    dispatch_interval = 5
+
+    def __init__(self, policy='fifo', overcommit=1.0):
+        if policy not in self.policies:
+            raise ValueError('Invalid admission policy: {0}'.format(policy))
+        self.policy = policy
+        self.overcommit = overcommit
+        self._nodes = {}
+        # uid -> (node name, cpu, memory) of every non-terminated pod
+        self._pods = {}
+        # Requests of the pods of each node (None for the unscheduled ones),
+        # so pods listed before their node are accounted once it is known
+        self._node_requests = collections.defaultdict(lambda: [0.0, 0.0])
+        self._reservations = {}
+        # Waiting submissions by function. The FIFO policy uses a single queue
+        self._queues = collections.OrderedDict()
+
+    def _get_allocatable(self):
+        cpu = sum(allocatable[0] for allocatable in self._nodes.values())
+        memory = sum(allocatable[1] for allocatable in self._nodes.values())
+        return cpu * self.overcommit, memory * self.overcommit
+
+    def _get_used(self):
+        now = time.monotonic()
+        for job_name in [name for name, (_, expiration) in self._reservations.items() if expiration < now]:
+            logging.warning('No pod observed for Job {0}, releasing its reservation'.format(job_name))
+            del self._reservations[job_name]
+        cpu, memory = 0.0, 0.0
+        for node_name, (node_cpu, node_memory) in self._node_requests.items():
+            # Pods running on nodes that do not accept Jobs are not accounted
+            if node_name is None or node_name in self._nodes:
+                cpu += node_cpu
+                memory += node_memory
+        for (job_cpu, job_memory), _ in self._reservations.values():
+            cpu += job_cpu
+            memory += job_memory
+        return cpu, memory
+
+    def get_free_capacity(self):
+        allocatable_cpu, allocatable_memory = self._get_allocatable()
+        used_cpu, used_memory = self._get_used()
+        return allocatable_cpu - used_cpu, allocatable_memory - used_memory
+
+    def _fits(self, requests, free):
+        if not self._nodes:
+            # Without capacity information the admission is not enforced
+            return True
+        allocatable = self._get_allocatable()
+        if requests[0] > allocatable[0] or requests[1] > allocatable[1]:
+            # It would never fit, so do not block the queue behind it
+            return True
+        return requests[0] <= free[0] and requests[1] <= free[1]
+
+    def _reserve(self, job_name, requests):
+        self._reservations[job_name] = (requests, time.monotonic() + self.reservation_timeout)
+
+    def release(self, job_name):
+        '''Frees the capacity reserved for a Job that could not be created'''
+        if self._reservations.pop(job_name, None):
+            self._dispatch()
+
+    def get_queue_length(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def admit(self, function_name, job_name, requests):
+        '''Waits until there is capacity for 'requests' (cpu, memory) and
+        reserves it for the Job 'job_name\''''
+        if not self.get_queue_length() and self._fits(requests, self.get_free_capacity()):
+            self._reserve(job_name, requests)
+            return
+        key = function_name if self.policy == 'fair' else None
+        future = asyncio.get_event_loop().create_future()
+        self._queues.setdefault(key, collections.deque()).append((job_name, requests, future))
+        metrics.ADMISSION_QUEUE_LENGTH.inc()
+        logging.info('Job {0} queued waiting for cluster capacity'.format(job_name))
+        try:
+            await future
+        except asyncio.CancelledError:
+            queue = self._queues.get(key)
+            if queue is not None:
+                self._queues[key] = collections.deque(item for item in queue if item[2] is not future)
+            metrics.ADMISSION_QUEUE_LENGTH.dec()
+            raise
+
+    def _dispatch(self):
+        if not self._queues:
+            return
+        free = list(self.get_free_capacity())
+        admitted = True
+        while admitted and self._queues:
+            admitted = False
+            # Round robin over the queues, admitting the head of each one
+            for key in list(self._queues):
+                queue = self._queues[key]
+                while queue and queue[0][2].done():
+                    queue.popleft()
+                if queue and self._fits(queue[0][1], free):
+                    job_name, requests, future = queue.popleft()
+                    self._reserve(job_name, requests)
+                    free[0] -= requests[0]
+                    free[1] -= requests[1]
+                    future.set_result(True)
+                    metrics.ADMISSION_QUEUE_LENGTH.dec()
+                    admitted = True
+                    # Move the served function to the end
+                    self._queues.move_to_end(key)
+                if not queue:
+                    del self._queues[key]
+
+    # Node watch handler
+    def _update_node(self, event_type, node):
+        name = node['metadata']['name']
+        if event_type == 'DELETED' or not is_node_schedulable(node):
+            self._nodes.pop(name, None)
+        else:
+            allocatable = node['status'].get('allocatable') or {}
+            self._nodes[name] = (utils.parse_quantity(allocatable.get('cpu', 0)),
+                                 utils.parse_quantity(allocatable.get('memory', 0)))
+
+    def resync_nodes(self, nodes):
+        self._nodes.clear()
+        for node in nodes:
+            self._update_node('ADDED', node)
+        self._dispatch()
+
+    def update_node(self, event_type, node):
+        self._update_node(event_type, node)
+        self._dispatch()
+
+    async def run(self):
+        # Periodically retry the queue so expired reservations are released
+        while True:
+            await asyncio.sleep(self.dispatch_interval)
+            self._dispatch()
+
+    # Pod watch handler (non-terminated pods of all namespaces)
+    def _update_pod(self, event_type, pod):
+        uid = pod['metadata']['uid']
+        previous = self._pods.pop(uid, None)
+        if previous:
+            node_requests = self._node_requests[previous[0]]
+            node_requests[0] -= previous[1]
+            node_requests[1] -= previous[2]
+        if event_type != 'DELETED' and pod['status'].get('phase') not in ('Succeeded', 'Failed'):
+            node_name = pod['spec'].get('nodeName') or None
+            cpu, memory = get_pod_requests(pod['spec'])
+            self._pods[uid] = (node_name, cpu, memory)
+            node_requests = self._node_requests[node_name]
+            node_requests[0] += cpu
+            node_requests[1] += memory
+        # Once the pod of an admitted Job exists it is accounted by itself
+        job_name = (pod['metadata'].get('labels') or {}).get('job-name')
+        if job_name:
+            self._reservations.pop(job_name, None)
+
+    def resync_pods(self, pods):
+        self._pods.clear()
+        self._node_requests.clear()
+        for pod in pods:
+            self._update_pod('ADDED', pod)
+        self._dispatch()
+
+    def update_pod(self, event_type, pod):
+        self._update_pod(event_type, pod)
+        self._dispatch()
@@ -0,0 +1,70 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+
+
+class Batch:
+
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.timer = None
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class EventBatcher:
+    '''Coalesces the events of each function into batches that are flushed
+    when they reach their maximum count or size, or after a linger time.
+
+    'flush' is a coroutine called with the function name and the list of
+    items of the batch, returning whether the batch was processed.'''
+
+    def __init__(self, flush, max_batch_bytes):
+        self.flush = flush
+        self.max_batch_bytes = max_batch_bytes
+        self._batches = {}
+
+    async def add(self, function_name, item, item_size, batch_size, linger):
+        '''Adds 'item' to the current batch of the function and waits until
+        the whole batch is flushed'''
+        batch = self._batches.get(function_name)
+        if batch and batch.size + item_size > self.max_batch_bytes:
+            self._flush(function_name)
+            batch = None
+        if batch is None:
+            batch = Batch()
+            batch.timer = asyncio.get_event_loop().call_later(linger, self._flush, function_name)
+            self._batches[function_name] = batch
+        batch.items.append(item)
+        batch.size += item_size
+        if len(batch.items) >= batch_size:
+            self._flush(function_name)
+        return await asyncio.shield(batch.future)
+
+    def _flush(self, function_name):
+        batch = self._batches.pop(function_name, None)
+        if batch:
+            batch.timer.cancel()
+            asyncio.ensure_future(self._run(function_name, batch))
+
+    async def _run(self, function_name, batch):
+        try:
+            result = await self.flush(function_name, batch.items)
+        except Exception as ex:
+            logging.error('Error launching batch of function {0}: {1}'.format(function_name, str(ex)))
+            result = False
+        batch.future.set_result(result)
@@ -0,0 +1,79 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import hashlib
+import time
+
+# Field added to the events by the subscribers with their queue identifier
+EVENT_ID_KEY = 'OscarEventId'
+
+# How events are identified:
+#  - sequence: by the identifier set by the subscriber (events without it
+#    are not deduplicated)
+#  - content: by the function, body and X-Call-Id header of the event
+SEQUENCE = 'sequence'
+CONTENT = 'content'
+
+
+def get_content_key(data):
+    call_id = (data.get('Header') or {}).get('X-Call-Id') or ['']
+    return '{0}\0{1}\0{2}'.format(data.get('Function', ''), call_id[0], data.get('Body', ''))
+
+
+class DeduplicationCache:
+    '''Bounded LRU cache with TTL of the keys of the launched events.
+
+    Keys are 32 hex characters derived from the event identity, so they are
+    also used to name its Job deterministically and let the API server
+    reject duplicates (409) after the key has been evicted.'''
+
+    def __init__(self, mode, max_size, ttl):
+        self.mode = mode
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> expiration time, in insertion (and expiration) order
+        self._keys = collections.OrderedDict()
+
+    def get_key(self, data):
+        if self.mode == CONTENT:
+            identity = get_content_key(data)
+        else:
+            identity = data.get(EVENT_ID_KEY)
+            if identity is None:
+                return None
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        expiration = self._keys.get(key)
+        if expiration is None:
+            return False
+        if expiration < time.monotonic():
+            del self._keys[key]
+            return False
+        return True
+
+    def add(self, key):
+        now = time.monotonic()
+        self._keys[key] = now + self.ttl
+        self._keys.move_to_end(key)
+        # Drop expired keys from the oldest, and the oldest ones when full
+        while self._keys:
+            oldest, expiration = next(iter(self._keys.items()))
+            if expiration >= now and len(self._keys) <= self.max_size:
+                break
+            del self._keys[oldest]
@@ -0,0 +1,58 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+
+class DeploymentCache:
+    '''Bounded LRU cache of function deployments kept current by a
+    ResourceWatcher on the functions namespace.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._deployments = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._deployments)
+
+    def names(self):
+        return self._deployments.keys()
+
+    def get(self, function_name):
+        deployment = self._deployments.get(function_name)
+        if deployment is not None:
+            self._deployments.move_to_end(function_name)
+        return deployment
+
+    def put(self, deployment):
+        name = deployment['metadata']['name']
+        self._deployments[name] = deployment
+        self._deployments.move_to_end(name)
+        while len(self._deployments) > self.max_size:
+            self._deployments.popitem(last=False)
+
+    def remove(self, function_name):
+        self._deployments.pop(function_name, None)
+
+    def resync(self, items):
+        self._deployments.clear()
+        for deployment in items[:self.max_size]:
+            self.put(deployment)
+
+    def update(self, event_type, obj):
+        if event_type == 'DELETED':
+            self.remove(obj['metadata']['name'])
+        elif event_type in ('ADDED', 'MODIFIED'):
+            self.put(obj)
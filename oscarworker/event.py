@@ -0,0 +1,92 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import json
+import random
+import time
+
+# Faster JSON parser, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    '''Parses a JSON document from bytes without decoding them first'''
+    if orjson is not None:
+        return orjson.loads(data)
+    # json.loads only takes bytes since Python 3.6 (and invalid UTF-8 raises
+    # a ValueError too, as orjson does)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+class Event(dict):
+    '''Event envelope sent by the OpenFaaS Gateway.
+
+    It is the parsed message itself, with the base64 encoded body decoded
+    at most once and only when it is needed.'''
+
+    __slots__ = ('_text', 'received_at', 'published_at')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received_at = time.time()
+        # Set by the subscribers that know it
+        self.published_at = None
+
+    @classmethod
+    def from_message(cls, data):
+        envelope = loads(data)
+        if not isinstance(envelope, dict):
+            raise ValueError('The event is not a JSON object')
+        return cls(envelope)
+
+    @classmethod
+    def wrap(cls, data):
+        return data if isinstance(data, cls) else cls(data)
+
+    @property
+    def function_name(self):
+        return self.get('Function', '')
+
+    @property
+    def size(self):
+        '''Size of the decoded body'''
+        body = self.get('Body') or ''
+        return len(body) * 3 // 4 - body[-2:].count('=')
+
+    @property
+    def text(self):
+        '''Body decoded as UTF-8 text'''
+        try:
+            return self._text
+        except AttributeError:
+            self._text = base64.b64decode(self.get('Body') or '').decode('utf-8')
+            return self._text
+
+    def preview(self, max_bytes):
+        '''Beginning of the body, decoding only the first 'max_bytes' bytes'''
+        body = self.get('Body') or ''
+        head = base64.b64decode(body[:(max_bytes + 2) // 3 * 4])[:max_bytes].decode('utf-8', errors='replace')
+        if self.size > max_bytes:
+            return '{0}... ({1} bytes)'.format(head, self.size)
+        return head
+
+
+def should_log(sample_rate):
+    return sample_rate >= 1 or random.random() < sample_rate
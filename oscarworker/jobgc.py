@@ -0,0 +1,162 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import calendar
+import logging
+import time
+from urllib.parse import urlencode
+import oscarworker.metrics as metrics
+from oscarworker.jobtemplate import MANAGED_LABEL, BUCKET_LABEL
+
+
+def is_job_finished(job):
+    for condition in job.get('status', {}).get('conditions') or []:
+        if condition['type'] in ('Complete', 'Failed') and condition['status'] == 'True':
+            return True
+    return False
+
+def get_finish_time(job):
+    # Time of the Complete/Failed transition (now if it can not be parsed)
+    status = job.get('status', {})
+    timestamp = status.get('completionTime')
+    if not timestamp:
+        for condition in status.get('conditions') or []:
+            if condition['type'] in ('Complete', 'Failed') and condition['status'] == 'True':
+                timestamp = condition.get('lastTransitionTime')
+    try:
+        return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class Bucket:
+    '''Jobs created in the same time bucket'''
+
+    def __init__(self):
+        self.running = set()
+        # Finished Job name -> succeeded
+        self.finished = {}
+        self.last_finish = 0
+        self.last_success = 0
+
+
+class JobCollector:
+    '''Deletes the finished Jobs created by the worker in bulk.
+
+    Jobs are labelled with their creation time bucket, so once every Job of
+    a bucket has finished for longer than the retention time, a single
+    'deletecollection' request selecting the bucket label removes them. In
+    buckets that still have running Jobs, the succeeded ones are deleted by
+    adding the 'status.successful=1' field selector.
+
+    It is fed by a ResourceWatcher on the managed Jobs, so its cost depends
+    on the Job churn instead of the number of Jobs in the namespace.'''
+
+    def __init__(self, kube_client, retention, interval=30, max_requests=10, propagation_policy='Background'):
+        self.kube_client = kube_client
+        self.retention = retention
+        self.interval = interval
+        # deletecollection requests per run
+        self.max_requests = max_requests
+        self.propagation_policy = propagation_policy
+        self._buckets = {}
+        self._jobs = {}
+
+    def _remove(self, name):
+        bucket_name = self._jobs.pop(name, None)
+        bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            return
+        bucket.running.discard(name)
+        bucket.finished.pop(name, None)
+        if not bucket.running and not bucket.finished:
+            del self._buckets[bucket_name]
+
+    def _add(self, job):
+        name = job['metadata']['name']
+        bucket_name = (job['metadata'].get('labels') or {}).get(BUCKET_LABEL)
+        if bucket_name is None:
+            return
+        self._remove(name)
+        bucket = self._buckets.setdefault(bucket_name, Bucket())
+        self._jobs[name] = bucket_name
+        if is_job_finished(job):
+            finish_time = get_finish_time(job)
+            # Same condition as the 'status.successful=1' field selector
+            succeeded = job['status'].get('succeeded') == 1
+            bucket.finished[name] = succeeded
+            bucket.last_finish = max(bucket.last_finish, finish_time)
+            if succeeded:
+                bucket.last_success = max(bucket.last_success, finish_time)
+        else:
+            bucket.running.add(name)
+
+    def resync(self, items):
+        self._buckets = {}
+        self._jobs = {}
+        for job in items:
+            self._add(job)
+
+    def update(self, event_type, obj):
+        if event_type == 'DELETED':
+            self._remove(obj['metadata']['name'])
+        elif event_type in ('ADDED', 'MODIFIED'):
+            self._add(obj)
+
+    async def _delete_collection(self, bucket_name, field_selector=None):
+        params = {'labelSelector': '{0}=true,{1}={2}'.format(MANAGED_LABEL, BUCKET_LABEL, bucket_name),
+                  'propagationPolicy': self.propagation_policy}
+        if field_selector:
+            params['fieldSelector'] = field_selector
+        url = self.kube_client._build_url('{0}?{1}'.format(self.kube_client.create_job_path, urlencode(params)))
+        status, _ = await self.kube_client._request('DELETE', url)
+        return status in [200, 202]
+
+    async def collect(self):
+        '''Sends the deletecollection requests of the expired buckets'''
+        deadline = time.time() - self.retention
+        requests = 0
+        for bucket_name in sorted(self._buckets):
+            if requests >= self.max_requests:
+                break
+            bucket = self._buckets.get(bucket_name)
+            if bucket is None or not bucket.finished:
+                continue
+            if not bucket.running and bucket.last_finish <= deadline:
+                requests += 1
+                if await self._delete_collection(bucket_name):
+                    logging.info('Deleted {0} finished Jobs of bucket {1}'.format(len(bucket.finished), bucket_name))
+                    metrics.JOBS_COLLECTED.inc(amount=len(bucket.finished))
+                    for name in list(bucket.finished):
+                        self._remove(name)
+            elif bucket.running and 0 < bucket.last_success <= deadline:
+                requests += 1
+                succeeded = [name for name, success in bucket.finished.items() if success]
+                if await self._delete_collection(bucket_name, 'status.successful=1'):
+                    logging.info('Deleted {0} succeeded Jobs of bucket {1}'.format(len(succeeded), bucket_name))
+                    metrics.JOBS_COLLECTED.inc(amount=len(succeeded))
+                    for name in succeeded:
+                        self._remove(name)
+                    bucket.last_success = 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.collect()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.error('Error collecting finished Jobs: {0}'.format(str(ex)))
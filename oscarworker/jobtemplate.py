@@ -0,0 +1,247 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+from json.encoder import encode_basestring_ascii
+import oscarworker.utils as utils
+
+DEFAULT_RESOURCES = {
+    'requests': {
+        'memory': '256Mi',
+        'cpu': '250m'
+    },
+    'limits': {
+        'memory': '256Mi',
+        'cpu': '250m'
+    }
+}
+
+EVENT_VOLUME_NAME = 'oscar-event'
+EVENT_MOUNT_PATH = '/oscar/event'
+# Events already processed by a sequential batch, kept across container restarts
+DONE_VOLUME_NAME = 'oscar-done'
+DONE_MOUNT_PATH = '/oscar/done'
+
+# How the Job receives its events:
+#  - inline: a single event in the EVENT environment variable
+#  - offload: a single event in a mounted ConfigMap
+#  - indexed: a batch of events in a mounted ConfigMap, one pod per index
+#  - sequential: a batch of events in a mounted ConfigMap, run one after another
+INLINE = 'inline'
+OFFLOAD = 'offload'
+INDEXED = 'indexed'
+SEQUENTIAL = 'sequential'
+
+EVENT_COMMANDS = {
+    INLINE: 'echo $EVENT | $fprocess',
+    # Offloaded events are read from the mounted file (gzipped when it helps)
+    OFFLOAD: ('if [ -f {0}/event.gz ]; then gunzip -c {0}/event.gz; '
+              'else cat {0}/event; fi | $fprocess').format(EVENT_MOUNT_PATH),
+    # Batched events are stored as 'event-<index>' with their HTTP variables
+    # in 'env-<index>'
+    INDEXED: ('. {0}/env-$JOB_COMPLETION_INDEX; '
+              'cat {0}/event-$JOB_COMPLETION_INDEX | $fprocess').format(EVENT_MOUNT_PATH),
+    # A restarted container skips the events that already succeeded
+    SEQUENTIAL: ('rc=0; for event in {0}/event-*; do i=${{event##*-}}; [ -f {1}/$i ] && continue; '
+                 '(. {0}/env-$i; cat $event | $fprocess) && touch {1}/$i || rc=1; done; '
+                 'exit $rc').format(EVENT_MOUNT_PATH, DONE_MOUNT_PATH)
+}
+
+# Deployment annotations (or labels) to enable batching for a function
+BATCH_SIZE_ANNOTATION = 'oscar.grycap/batch-size'
+BATCH_LINGER_ANNOTATION = 'oscar.grycap/batch-linger-ms'
+DEFAULT_BATCH_LINGER = 100
+
+# Labels of the Jobs created by the worker, used to delete them in bulk
+MANAGED_LABEL = 'oscar-worker/managed'
+BUCKET_LABEL = 'oscar-worker/bucket'
+# Label of the Job pods with their function
+FUNCTION_LABEL = 'oscar-worker/function'
+
+# Annotations of the traced Jobs and their pods
+TRACE_ID_ANNOTATION = 'oscar-worker/trace-id'
+RECEIVED_ANNOTATION = 'oscar-worker/received-at'
+POSTED_ANNOTATION = 'oscar-worker/posted-at'
+
+ENV_NAME_PREFIX = b'{"name":'
+ENV_VALUE_PREFIX = b',"value":'
+ENV_SUFFIX = b'}'
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+def encode(value):
+    return _encoder.encode(value).encode('utf-8')
+
+def encode_string(value):
+    return encode_basestring_ascii(value).encode('ascii')
+
+def encode_env(name, value):
+    return b''.join((ENV_NAME_PREFIX, encode_string(name), ENV_VALUE_PREFIX, encode_string(value), ENV_SUFFIX))
+
+def get_deployment_setting(deployment_info, key, default=None):
+    '''Reads a setting from the deployment annotations or labels'''
+    metadata = deployment_info['metadata']
+    for source in (metadata.get('annotations'), metadata.get('labels')):
+        if source and key in source:
+            return source[key]
+    return default
+
+def slot(name):
+    '''Placeholder for a value that is filled in on each render'''
+    return '__oscar_slot_{0}__'.format(name)
+
+
+class JobTemplate:
+    '''Job skeleton compiled from a function deployment.
+
+    The skeleton is serialized once and split around its slots, so rendering
+    a Job only encodes the per-event fields and joins byte fragments.'''
+
+    def __init__(self, skeleton, base_env, requests=(0.0, 0.0), mode=INLINE):
+        # (cpu, memory) requested by each Job pod
+        self.requests = requests
+        self.mode = mode
+        self.batch_size = 1
+        self.batch_linger = DEFAULT_BATCH_LINGER / 1000
+        self._base_env = b','.join(encode(env) for env in base_env)
+        self._fragments = []
+        self.slots = set()
+        serialized = encode(skeleton)
+        while True:
+            start = serialized.find(b'"__oscar_slot_')
+            if start < 0:
+                self._fragments.append(serialized)
+                break
+            end = serialized.index(b'__"', start) + 3
+            name = serialized[start + 14:end - 3].decode('utf-8')
+            self._fragments.append(serialized[:start])
+            self._fragments.append(name)
+            self.slots.add(name)
+            serialized = serialized[end:]
+
+    @classmethod
+    def from_deployment(cls, deployment_info, namespace, backoff_limit, ttl_seconds_after_finished=None,
+                        mode=INLINE, default_resources=None, traced=False):
+        pod_spec = deployment_info['spec']['template']['spec']
+        container_info = pod_spec['containers'][0]
+
+        # Set default resources if they are not specified in the deployment
+        if 'resources' in container_info and bool(container_info['resources']):
+            resources = container_info['resources']
+        else:
+            resources = default_resources or DEFAULT_RESOURCES
+
+        job = {
+            'apiVersion': 'batch/v1',
+            'kind': 'Job',
+            'metadata': {
+                'name': slot('name'),
+                'namespace': namespace,
+                'labels': {
+                    MANAGED_LABEL: 'true',
+                    # Creation time bucket
+                    BUCKET_LABEL: slot('bucket')
+                }
+            },
+            'spec': {
+                'backoffLimit': int(backoff_limit),
+                'template': {
+                    'metadata': {
+                        'labels': {
+                            FUNCTION_LABEL: deployment_info['metadata']['name']
+                        }
+                    },
+                    'spec': {
+                        'containers': [
+                            {
+                                'name': container_info['name'],
+                                'image': container_info['image'],
+                                'command': ['/bin/sh'],
+                                'args': ['-c', EVENT_COMMANDS[mode]],
+                                'env': slot('env'),
+                                'resources': resources,
+                                'volumeMounts': container_info.get('volumeMounts', [])
+                            }
+                        ],
+                        'volumes': pod_spec.get('volumes', []),
+                        'restartPolicy': 'OnFailure'
+                    }
+                }
+            }
+        }
+        # Mount the ConfigMap holding the events (named as the Job)
+        if mode != INLINE:
+            container = job['spec']['template']['spec']['containers'][0]
+            container['volumeMounts'] = container['volumeMounts'] + [
+                {'name': EVENT_VOLUME_NAME, 'mountPath': EVENT_MOUNT_PATH, 'readOnly': True}]
+            job['spec']['template']['spec']['volumes'] = job['spec']['template']['spec']['volumes'] + [
+                {'name': EVENT_VOLUME_NAME, 'configMap': {'name': slot('name')}}]
+
+        if mode == SEQUENTIAL:
+            container['volumeMounts'] = container['volumeMounts'] + [
+                {'name': DONE_VOLUME_NAME, 'mountPath': DONE_MOUNT_PATH}]
+            job['spec']['template']['spec']['volumes'] = job['spec']['template']['spec']['volumes'] + [
+                {'name': DONE_VOLUME_NAME, 'emptyDir': {}}]
+
+        if mode == INDEXED:
+            job['spec']['completionMode'] = 'Indexed'
+            job['spec']['completions'] = slot('completions')
+            job['spec']['parallelism'] = slot('completions')
+
+        # Trace ID and timestamps (in seconds since the epoch) of the event
+        if traced:
+            annotations = {
+                TRACE_ID_ANNOTATION: slot('trace_id'),
+                RECEIVED_ANNOTATION: slot('received_at'),
+                POSTED_ANNOTATION: slot('posted_at')
+            }
+            job['metadata']['annotations'] = annotations
+            job['spec']['template']['metadata']['annotations'] = annotations
+
+        if ttl_seconds_after_finished is not None:
+            job['spec']['ttlSecondsAfterFinished'] = int(ttl_seconds_after_finished)
+
+        pod_requests = resources.get('requests') or resources.get('limits') or {}
+        requests = (utils.parse_quantity(pod_requests.get('cpu', 0)),
+                    utils.parse_quantity(pod_requests.get('memory', 0)))
+
+        template = cls(job, container_info.get('env', []), requests, mode)
+        try:
+            template.batch_size = int(get_deployment_setting(deployment_info, BATCH_SIZE_ANNOTATION, 1))
+            template.batch_linger = int(get_deployment_setting(deployment_info, BATCH_LINGER_ANNOTATION,
+                                                               DEFAULT_BATCH_LINGER)) / 1000
+        except ValueError:
+            logging.warning('Invalid batching settings for function "{0}", events are not batched'.format(
+                deployment_info['metadata']['name']))
+            template.batch_size = 1
+            template.batch_linger = DEFAULT_BATCH_LINGER / 1000
+        return template
+
+    def _render_env(self, envs):
+        extra = b','.join(encode_env(env['name'], env['value']) for env in envs)
+        if self._base_env and extra:
+            return b''.join((b'[', self._base_env, b',', extra, b']'))
+        return b''.join((b'[', self._base_env or extra, b']'))
+
+    def render(self, name, envs, **values):
+        '''Returns the serialized Job named 'name' with 'envs' appended to the
+        deployment environment variables. Other slots are set from 'values'.'''
+        values = {key: encode(value) for key, value in values.items()}
+        values['name'] = encode_string(name)
+        values['env'] = self._render_env(envs)
+        return b''.join([values[fragment] if fragment.__class__ is str else fragment
+                         for fragment in self._fragments])
@@ -14,18 +14,47 @@
 # limitations under the License.
 
 from packaging import version
+import asyncio
+import base64
+import collections
+import gzip
+import hashlib
 import logging
 import uuid
 import os.path
-import requests
+import re
+import shlex
+import socket
+import time
 import oscarworker.utils as utils
+import oscarworker.jobtemplate as jobtemplate
+import oscarworker.metrics as metrics
+import oscarworker.profiler as profiler
+import oscarworker.scheduler as scheduler
+import oscarworker.targets as targets
+from oscarworker.admission import AdmissionController
+from oscarworker.batcher import EventBatcher
+from oscarworker.dedup import DeduplicationCache
+from oscarworker.deploymentcache import DeploymentCache
+from oscarworker.event import Event, should_log
+from oscarworker.jobgc import JobCollector
+from oscarworker.profiler import ResourceProfiler
+from oscarworker.spool import EventSpool
+from oscarworker.tracing import Trace, Tracer, FileExporter, OtlpExporter
+from oscarworker.jobtemplate import JobTemplate
+from oscarworker.warmpool import WarmPool, OWNER_LABEL, get_owner
+from oscarworker.watcher import ResourceWatcher, WatchHandler
 
 
 class KubernetesClient:
 
-    deployment_list_path = '/apis/apps/v1/namespaces/openfaas-fn/deployments/'
-    create_job_path = '/apis/batch/v1/namespaces/oscar-fn/jobs'
+    deployment_list_path = '/apis/apps/v1/namespaces/openfaas-fn/deployments'
+    job_namespace = 'oscar-fn'
+    # Kubernetes objects can not exceed 1MiB, leave room for the metadata
+    max_config_map_data = 1000 * 1024
     nodes_info_path = '/api/v1/nodes'
+    version_path = '/version'
+    pods_path = '/api/v1/pods'
 
     def __init__(self):
         self.token = utils.get_environment_variable('KUBE_TOKEN')
@@ -45,6 +74,11 @@ class KubernetesClient:
         if not self.kubernetes_service_port:
             self.kubernetes_service_port = '443'
 
+        # 'http' allows using 'kubectl proxy' or local stub API servers
+        self.kubernetes_service_scheme = utils.get_environment_variable('KUBERNETES_SERVICE_SCHEME')
+        if not self.kubernetes_service_scheme:
+            self.kubernetes_service_scheme = 'https'
+
         self.job_ttl_seconds_after_finished = utils.get_environment_variable('JOB_TTL_SECONDS_AFTER_FINISHED')
         if not self.job_ttl_seconds_after_finished:
             self.job_ttl_seconds_after_finished = 60
@@ -53,116 +87,609 @@ class KubernetesClient:
         if not self.job_backoff_limit:
             self.job_backoff_limit = 6
 
-    def _gen_auth_header(self):
-        return {'Authorization': 'Bearer ' + self.token}
+        # Maximum number of simultaneous keep-alive connections to the API server
+        self.pool_size = utils.get_environment_variable('KUBE_POOL_SIZE')
+        if not self.pool_size:
+            self.pool_size = 20
 
-    def _create_request(self, method, url, headers=None, json=None):
-        try:
-            if headers is None:
-                headers = {}
-            headers.update(self._gen_auth_header())
-
-            resp = requests.request(method, url, verify=self._cert_verify, headers=headers, json=json)
-            if resp.status_code in [200, 201, 202]:
-                return resp.json()
-            else:
-                logging.error('Error contacting Kubernetes API: {0} - {1}'.format(resp.status_code, resp.text))
-                return None
-        except Exception as ex:
-            logging.error('Error contacting Kubernetes API: {0}'.format(str(ex)))
-            return None
+        # Events larger than this size (bytes) are mounted from a ConfigMap
+        # instead of passed in the EVENT environment variable
+        self.event_offload_threshold = utils.get_environment_variable('EVENT_OFFLOAD_THRESHOLD')
+        if not self.event_offload_threshold:
+            self.event_offload_threshold = 32 * 1024
+
+        # Maximum number of function deployments kept in memory
+        self.deployment_cache_size = utils.get_environment_variable('DEPLOYMENT_CACHE_SIZE')
+        if not self.deployment_cache_size:
+            self.deployment_cache_size = 1000
+
+        self.deployment_cache = DeploymentCache(int(self.deployment_cache_size))
+        self.deployment_watcher = ResourceWatcher(self, self.deployment_list_path)
+        self.deployment_watcher.add_handler(self.deployment_cache)
+
+        # Hold Jobs until the cluster has capacity for them ('none', 'fifo' or 'fair')
+        self.admission_policy = utils.get_environment_variable('ADMISSION_POLICY')
+        if not self.admission_policy:
+            self.admission_policy = 'none'
+
+        # Factor applied to the allocatable resources of the cluster
+        self.admission_overcommit = utils.get_environment_variable('ADMISSION_OVERCOMMIT')
+        if not self.admission_overcommit:
+            self.admission_overcommit = 1.0
+
+        self.admission = None
+        self._admission_watchers = []
+        if self.admission_policy != 'none':
+            # Each process of a multi-process worker admits Jobs for its share
+            # of the cluster capacity
+            worker_count = utils.get_environment_variable('WORKER_COUNT')
+            capacity_share = 1.0 / int(worker_count) if worker_count else 1.0
+            self.admission = AdmissionController(self.admission_policy,
+                                                 float(self.admission_overcommit) * capacity_share)
+            node_watcher = ResourceWatcher(self, self.nodes_info_path)
+            node_watcher.add_handler(WatchHandler(self.admission.resync_nodes, self.admission.update_node))
+            pod_watcher = ResourceWatcher(self, self.pods_path,
+                                          field_selector='status.phase!=Succeeded,status.phase!=Failed')
+            pod_watcher.add_handler(WatchHandler(self.admission.resync_pods, self.admission.update_pod))
+            self._admission_watchers = [node_watcher, pod_watcher]
+
+        # Initial and maximum requests per second to the k8s API server
+        self.kube_qps = utils.get_environment_variable('KUBE_QPS')
+        if not self.kube_qps:
+            self.kube_qps = 200
+
+        self.kube_max_qps = utils.get_environment_variable('KUBE_MAX_QPS')
+        if not self.kube_max_qps:
+            self.kube_max_qps = 2000
+
+        self.kube_burst = utils.get_environment_variable('KUBE_BURST')
+        if not self.kube_burst:
+            self.kube_burst = 200
+
+        self.max_retries = utils.get_environment_variable('KUBE_MAX_RETRIES')
+        if not self.max_retries:
+            self.max_retries = 5
+
+        # Seconds to connect to the k8s API server and to wait for each read
+        # of a response, so a hung server fails the request and is retried
+        self.connect_timeout = utils.get_environment_variable('KUBE_CONNECT_TIMEOUT')
+        if not self.connect_timeout:
+            self.connect_timeout = 10
+
+        self.read_timeout = utils.get_environment_variable('KUBE_READ_TIMEOUT')
+        if not self.read_timeout:
+            self.read_timeout = 30
+
+        # Clusters or namespaces where Jobs are created, as a JSON list of
+        # objects whose missing settings are taken from the variables above.
+        # The first one (the primary) also holds the function deployments
+        self.kubernetes_targets = utils.get_environment_variable('KUBERNETES_TARGETS')
+        targets_file = utils.get_environment_variable('KUBERNETES_TARGETS_FILE')
+        if not self.kubernetes_targets and targets_file:
+            self.kubernetes_targets = utils.read_file(targets_file)
+        if not self.kubernetes_targets:
+            self.kubernetes_targets = '[{"name": "default"}]'
+
+        # 'least-loaded' or 'weighted'
+        self.routing_policy = utils.get_environment_variable('ROUTING_POLICY')
+        if not self.routing_policy:
+            self.routing_policy = targets.LEAST_LOADED
+
+        # Consecutive failed Job posts before failing over to other targets
+        self.target_failure_threshold = utils.get_environment_variable('TARGET_FAILURE_THRESHOLD')
+        if not self.target_failure_threshold:
+            self.target_failure_threshold = 3
+
+        self.target_health_interval = utils.get_environment_variable('TARGET_HEALTH_INTERVAL')
+        if not self.target_health_interval:
+            self.target_health_interval = 5
+
+        self.targets = targets.load_targets(self.kubernetes_targets, {
+            'host': self.kubernetes_service_host,
+            'port': self.kubernetes_service_port,
+            'scheme': self.kubernetes_service_scheme,
+            'token': self.token,
+            'ca_file': self._cert_verify,
+            'namespace': self.job_namespace,
+            'pool_size': self.pool_size,
+            'qps': self.kube_qps,
+            'burst': self.kube_burst,
+            'max_qps': self.kube_max_qps,
+            'max_retries': self.max_retries,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout
+        })
+        self.target = self.targets[0]
+        self.job_namespace = self.target.namespace
+        self.create_job_path = self.target.create_job_path
+        self.create_config_map_path = self.target.create_config_map_path
+        self.router = targets.TargetRouter(self.targets, self.routing_policy, int(self.target_failure_threshold),
+                                           float(self.target_health_interval))
+        # Admission reserves the capacity of a single cluster before the
+        # target of the Job is chosen
+        if self.admission is not None and len(self.targets) > 1:
+            raise ValueError('ADMISSION_POLICY is not supported with several KUBERNETES_TARGETS')
+
+        # Delete finished Jobs in bulk: 'auto' enables it when the cluster does
+        # not support ttlSecondsAfterFinished, 'true' or 'false' force it
+        self.job_gc = utils.get_environment_variable('JOB_GC')
+        if not self.job_gc:
+            self.job_gc = 'auto'
+
+        # Seconds that finished Jobs are kept before being deleted
+        self.job_gc_retention = utils.get_environment_variable('JOB_GC_RETENTION_SECONDS')
+        if not self.job_gc_retention:
+            self.job_gc_retention = self.job_ttl_seconds_after_finished
+
+        # Jobs created in the same bucket (seconds) are deleted together
+        self.job_gc_bucket = utils.get_environment_variable('JOB_GC_BUCKET_SECONDS')
+        if not self.job_gc_bucket:
+            self.job_gc_bucket = 60
+
+        self.job_gc_interval = utils.get_environment_variable('JOB_GC_INTERVAL')
+        if not self.job_gc_interval:
+            self.job_gc_interval = 30
+
+        # Maximum deletecollection requests on each interval
+        self.job_gc_max_requests = utils.get_environment_variable('JOB_GC_MAX_REQUESTS')
+        if not self.job_gc_max_requests:
+            self.job_gc_max_requests = 10
+
+        # 'Background' or 'Foreground' deletion of the Job pods
+        self.job_gc_propagation_policy = utils.get_environment_variable('JOB_GC_PROPAGATION_POLICY')
+        if not self.job_gc_propagation_policy:
+            self.job_gc_propagation_policy = 'Background'
+
+        # Collector and watcher of the Jobs of each target
+        self.job_collectors = []
+        # Only the first process of a multi-process worker collects Jobs
+        if self.job_gc != 'false' and int(utils.get_environment_variable('WORKER_INDEX') or 0) == 0:
+            for target in self.targets:
+                job_collector = JobCollector(target, int(self.job_gc_retention), int(self.job_gc_interval),
+                                             int(self.job_gc_max_requests), self.job_gc_propagation_policy)
+                job_watcher = ResourceWatcher(target, target.create_job_path,
+                                              label_selector='{0}=true'.format(jobtemplate.MANAGED_LABEL))
+                job_watcher.add_handler(job_collector)
+                self.job_collectors.append((job_collector, job_watcher))
+
+        # Keep warm executor pods for the functions that enable it
+        self.warm_pool_enabled = utils.get_environment_variable('WARM_POOL')
+        if not self.warm_pool_enabled:
+            self.warm_pool_enabled = 'false'
+
+        # Seconds without events before removing the executors of a function
+        self.warm_pool_idle = utils.get_environment_variable('WARM_POOL_IDLE_SECONDS')
+        if not self.warm_pool_idle:
+            self.warm_pool_idle = 300
+
+        # Maximum execution time of an event sent to an executor
+        self.warm_pool_timeout = utils.get_environment_variable('WARM_POOL_TIMEOUT')
+        if not self.warm_pool_timeout:
+            self.warm_pool_timeout = 300
+
+        self.warm_pool = None
+        self._warm_pool_watcher = None
+        if self.warm_pool_enabled == 'true':
+            # Each process manages its own executors. The worker pod is set
+            # with the downward API (POD_NAME and POD_NAMESPACE), so the first
+            # process can delete the executors of the pods that no longer exist
+            owner_pod = utils.get_environment_variable('POD_NAME')
+            owner_pod_namespace = None
+            worker_index = int(utils.get_environment_variable('WORKER_INDEX') or 0)
+            if owner_pod and worker_index == 0:
+                owner_pod_namespace = utils.get_environment_variable('POD_NAMESPACE')
+            owner = get_owner(owner_pod or socket.gethostname(), worker_index)
+            self.warm_pool = WarmPool(self, self.job_namespace, owner, self._launch_fallback,
+                                      int(self.warm_pool_idle), int(self.warm_pool_timeout),
+                                      owner_pod=owner_pod, owner_pod_namespace=owner_pod_namespace,
+                                      worker_count=int(utils.get_environment_variable('WORKER_COUNT') or 1))
+            self._warm_pool_watcher = ResourceWatcher(self, self.warm_pool.pods_path,
+                                                      label_selector='{0}={1}'.format(OWNER_LABEL, owner))
+            self._warm_pool_watcher.add_handler(self.warm_pool)
+
+        # Size the Jobs of the functions without resources from their previous pods
+        self.rightsizing = utils.get_environment_variable('RIGHTSIZING')
+        if not self.rightsizing:
+            self.rightsizing = 'false'
+
+        # Percentiles of the observed usage used as requests and limits
+        self.rightsizing_request_percentile = utils.get_environment_variable('RIGHTSIZING_REQUEST_PERCENTILE')
+        if not self.rightsizing_request_percentile:
+            self.rightsizing_request_percentile = 0.9
+
+        self.rightsizing_limit_percentile = utils.get_environment_variable('RIGHTSIZING_LIMIT_PERCENTILE')
+        if not self.rightsizing_limit_percentile:
+            self.rightsizing_limit_percentile = 0.99
+
+        # Factor applied to the percentiles
+        self.rightsizing_margin = utils.get_environment_variable('RIGHTSIZING_MARGIN')
+        if not self.rightsizing_margin:
+            self.rightsizing_margin = 1.15
+
+        # Samples of a resource needed before changing its default
+        self.rightsizing_min_samples = utils.get_environment_variable('RIGHTSIZING_MIN_SAMPLES')
+        if not self.rightsizing_min_samples:
+            self.rightsizing_min_samples = 10
+
+        # Hours for a sample to lose half of its weight
+        self.rightsizing_half_life = utils.get_environment_variable('RIGHTSIZING_HALF_LIFE_HOURS')
+        if not self.rightsizing_half_life:
+            self.rightsizing_half_life = 24
+
+        self.rightsizing_min_cpu = utils.get_environment_variable('RIGHTSIZING_MIN_CPU')
+        if not self.rightsizing_min_cpu:
+            self.rightsizing_min_cpu = '10m'
+
+        self.rightsizing_max_cpu = utils.get_environment_variable('RIGHTSIZING_MAX_CPU')
+        if not self.rightsizing_max_cpu:
+            self.rightsizing_max_cpu = '4'
+
+        self.rightsizing_min_memory = utils.get_environment_variable('RIGHTSIZING_MIN_MEMORY')
+        if not self.rightsizing_min_memory:
+            self.rightsizing_min_memory = '32Mi'
+
+        self.rightsizing_max_memory = utils.get_environment_variable('RIGHTSIZING_MAX_MEMORY')
+        if not self.rightsizing_max_memory:
+            self.rightsizing_max_memory = '8Gi'
+
+        # Seconds between samples of the metrics API (0 only uses OOM kills)
+        self.rightsizing_metrics_interval = utils.get_environment_variable('RIGHTSIZING_METRICS_INTERVAL')
+        if not self.rightsizing_metrics_interval:
+            self.rightsizing_metrics_interval = 15
+
+        # Watch on the Job pods, shared by the profiler and the tracer
+        self._job_pod_watcher = ResourceWatcher(self, '/api/v1/namespaces/{0}/pods'.format(self.job_namespace),
+                                                label_selector=jobtemplate.FUNCTION_LABEL)
+
+        self.profiler = None
+        if self.rightsizing == 'true':
+            defaults = jobtemplate.DEFAULT_RESOURCES
+            self.profiler = ResourceProfiler(
+                self, self.job_namespace,
+                tuple(utils.parse_quantity(defaults[kind][resource])
+                      for resource in ('cpu', 'memory') for kind in ('requests', 'limits')),
+                request_percentile=float(self.rightsizing_request_percentile),
+                limit_percentile=float(self.rightsizing_limit_percentile),
+                margin=float(self.rightsizing_margin),
+                min_samples=int(self.rightsizing_min_samples),
+                half_life=float(self.rightsizing_half_life) * 3600,
+                bounds=((utils.parse_quantity(self.rightsizing_min_cpu),
+                         utils.parse_quantity(self.rightsizing_max_cpu)),
+                        (utils.parse_quantity(self.rightsizing_min_memory),
+                         utils.parse_quantity(self.rightsizing_max_memory))),
+                metrics_interval=float(self.rightsizing_metrics_interval))
+            self._job_pod_watcher.add_handler(self.profiler)
+
+        # Record the latency of each stage of the invocations
+        self.tracing = utils.get_environment_variable('TRACING')
+        if not self.tracing:
+            self.tracing = 'false'
+
+        # Destination of the spans: 'none' (only metrics), 'file' or 'otlp'
+        self.tracing_exporter = utils.get_environment_variable('TRACING_EXPORTER')
+        if not self.tracing_exporter:
+            self.tracing_exporter = 'none'
+
+        self.tracing_file = utils.get_environment_variable('TRACING_FILE')
+        if not self.tracing_file:
+            self.tracing_file = '/tmp/oscar-worker-spans.jsonl'
+
+        # OTLP/HTTP endpoint of an OpenTelemetry collector
+        self.tracing_otlp_endpoint = utils.get_environment_variable('TRACING_OTLP_ENDPOINT')
+        if not self.tracing_otlp_endpoint:
+            self.tracing_otlp_endpoint = 'http://localhost:4318'
+
+        # Seconds between span exports
+        self.tracing_export_interval = utils.get_environment_variable('TRACING_EXPORT_INTERVAL')
+        if not self.tracing_export_interval:
+            self.tracing_export_interval = 5
+
+        self.tracer = None
+        if self.tracing == 'true':
+            exporter = None
+            if self.tracing_exporter == 'file':
+                exporter = FileExporter(self.tracing_file, float(self.tracing_export_interval))
+            elif self.tracing_exporter == 'otlp':
+                exporter = OtlpExporter(self.tracing_otlp_endpoint, interval=float(self.tracing_export_interval))
+            # Only the first process of a multi-process worker follows the pods
+            watch_pods = int(utils.get_environment_variable('WORKER_INDEX') or 0) == 0
+            self.tracer = Tracer(exporter, watch_pods)
+            if watch_pods:
+                self._job_pod_watcher.add_handler(self.tracer)
+
+        # Active Jobs and pending pods of each target, only needed to route
+        # the Jobs when there are several
+        self._target_watchers = []
+        if len(self.targets) > 1:
+            for target in self.targets:
+                job_watcher = ResourceWatcher(target, target.create_job_path,
+                                              label_selector='{0}=true'.format(jobtemplate.MANAGED_LABEL))
+                job_watcher.add_handler(WatchHandler(target.resync_jobs, target.update_job))
+                self._target_watchers.append(job_watcher)
+                pod_handler = WatchHandler(target.resync_pods, target.update_pod)
+                if target is self.target:
+                    self._job_pod_watcher.add_handler(pod_handler)
+                else:
+                    pod_watcher = ResourceWatcher(target, target.pods_path, label_selector=jobtemplate.FUNCTION_LABEL)
+                    pod_watcher.add_handler(pod_handler)
+                    # The pods of every target are traced
+                    if self.tracer is not None and self.tracer.watch_pods:
+                        pod_watcher.add_handler(self.tracer)
+                    self._target_watchers.append(pod_watcher)
+
+        # Ratio of the received events that are logged, and how much of their body
+        self.event_log_sample_rate = utils.get_environment_variable('EVENT_LOG_SAMPLE_RATE')
+        if not self.event_log_sample_rate:
+            self.event_log_sample_rate = 1.0
+
+        self.event_log_preview_bytes = utils.get_environment_variable('EVENT_LOG_PREVIEW_BYTES')
+        if not self.event_log_preview_bytes:
+            self.event_log_preview_bytes = 256
+
+        # Skip redelivered events: 'sequence', 'content' or 'none'
+        self.dedup_mode = utils.get_environment_variable('DEDUP_KEY')
+        if not self.dedup_mode:
+            self.dedup_mode = 'sequence'
+
+        self.dedup_cache_size = utils.get_environment_variable('DEDUP_CACHE_SIZE')
+        if not self.dedup_cache_size:
+            self.dedup_cache_size = 100000
+
+        # Seconds that launched events are remembered
+        self.dedup_ttl = utils.get_environment_variable('DEDUP_TTL_SECONDS')
+        if not self.dedup_ttl:
+            self.dedup_ttl = 3600
 
-    def _get_deployment_info(self, function_name):
-        url = 'https://{0}:{1}{2}{3}'.format(self.kubernetes_service_host,
-                                             self.kubernetes_service_port,
-                                             self.deployment_list_path,
-                                             function_name)
-        deployment_info = self._create_request('GET', url)
+        self.dedup_cache = None
+        if self.dedup_mode != 'none':
+            self.dedup_cache = DeduplicationCache(self.dedup_mode, int(self.dedup_cache_size), float(self.dedup_ttl))
+
+        # Events whose Job could not be created while the API server was
+        # unavailable are stored in this directory and replayed later
+        self.spool_dir = utils.get_environment_variable('SPOOL_DIR')
+
+        self.spool_max_bytes = utils.get_environment_variable('SPOOL_MAX_BYTES')
+        if not self.spool_max_bytes:
+            self.spool_max_bytes = 512 * 1024 * 1024
+
+        # Appends are fsynced together at most this often
+        self.spool_fsync_interval = utils.get_environment_variable('SPOOL_FSYNC_INTERVAL_MS')
+        if not self.spool_fsync_interval:
+            self.spool_fsync_interval = 10
+
+        self.spool_drain_concurrency = utils.get_environment_variable('SPOOL_DRAIN_CONCURRENCY')
+        if not self.spool_drain_concurrency:
+            self.spool_drain_concurrency = 8
+
+        self.spool_max_attempts = utils.get_environment_variable('SPOOL_MAX_ATTEMPTS')
+        if not self.spool_max_attempts:
+            self.spool_max_attempts = 10
+
+        self.spool = None
+        if self.spool_dir:
+            # One spool per worker process, sharing the maximum size
+            worker_index = utils.get_environment_variable('WORKER_INDEX') or 0
+            worker_count = utils.get_environment_variable('WORKER_COUNT') or 1
+            self.spool = EventSpool(utils.join_paths(self.spool_dir, 'worker-{0}'.format(worker_index)),
+                                    int(self.spool_max_bytes) // int(worker_count),
+                                    fsync_interval=int(self.spool_fsync_interval) / 1000,
+                                    drain_concurrency=int(self.spool_drain_concurrency),
+                                    max_attempts=int(self.spool_max_attempts))
+
+        # Set once the startup warm-up has finished
+        self.ready = False
+        self._job_templates = collections.OrderedDict()
+        self.batcher = EventBatcher(self._launch_batch, self.max_config_map_data)
+        self._tasks = []
+
+    def _build_url(self, path):
+        return self.target._build_url(path)
+
+    # Requests not related to a Job go to the primary target
+    async def _send_request(self, method, url, headers, json, data, function_name):
+        return await self.target._send_request(method, url, headers, json, data, function_name)
+
+    async def _request(self, method, url, headers=None, json=None, data=None, function_name=''):
+        return await self.target._request(method, url, headers, json, data, function_name)
+
+    async def _create_request(self, method, url, headers=None, json=None, data=None, function_name=''):
+        return await self.target._create_request(method, url, headers, json, data, function_name)
+
+    async def _watch_request(self, url, callback):
+        await self.target._watch_request(url, callback)
+
+    async def _warm_up_connections(self):
+        # Open the pool connections (TLS handshakes included) in advance
+        await asyncio.gather(*[target._create_request('GET', target._build_url(self.version_path))
+                               for target in self.targets for _ in range(int(target.pool_size))])
+
+    async def start(self):
+        # Resolve the server version, seed the deployment cache and the
+        # capacity of the cluster and open connections concurrently
+        watchers = [self.deployment_watcher] + self._admission_watchers + self._target_watchers
+        if self.warm_pool is not None:
+            watchers.append(self._warm_pool_watcher)
+        if self._job_pod_watcher.handlers:
+            watchers.append(self._job_pod_watcher)
+        await asyncio.gather(self._get_kubernetes_version(),
+                             self._warm_up_connections(),
+                             *[watcher.list() for watcher in watchers])
+
+        # Keep them updated in background
+        for watcher in watchers:
+            self._tasks.append(asyncio.ensure_future(watcher.run()))
+        if self.admission:
+            self._tasks.append(asyncio.ensure_future(self.admission.run()))
+        if self.warm_pool is not None:
+            self._tasks.append(asyncio.ensure_future(self.warm_pool.run()))
+        if self.profiler is not None:
+            self._tasks.append(asyncio.ensure_future(self.profiler.run()))
+        if self.tracer is not None:
+            self._tasks.append(asyncio.ensure_future(self.tracer.run()))
+        if len(self.targets) > 1:
+            self._tasks.append(asyncio.ensure_future(self.router.run()))
+        # TTL-after-finished is enabled by default since Kubernetes v1.21
+        if self.job_collectors and self.job_gc == 'auto' and await self._is_kubernetes_version_at_least('v1.21'):
+            self.job_collectors = []
+        if self.job_collectors:
+            logging.info('Collecting finished Jobs after {0} seconds'.format(self.job_gc_retention))
+        for job_collector, job_watcher in self.job_collectors:
+            self._tasks.append(asyncio.ensure_future(job_watcher.run()))
+            self._tasks.append(asyncio.ensure_future(job_collector.run()))
+        if self.spool is not None:
+            self.spool.open()
+            self._tasks.append(asyncio.ensure_future(self.spool.drain(self._launch_job, self._is_api_available)))
+
+        # Compile the Job templates of the known functions
+        for function_name in list(self.deployment_cache.names()):
+            await self._get_job_template(function_name)
+
+        self.ready = True
+        logging.info('Warm-up finished: {0} function deployments cached'.format(len(self.deployment_cache)))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.spool is not None:
+            self.spool.close()
+        if self.warm_pool is not None:
+            await self.warm_pool.close()
+        if self.tracer is not None:
+            await self.tracer.close()
+        for target in self.targets:
+            await target.close()
+
+    async def _is_api_available(self):
+        # Jobs can be created while any target is available
+        for target in self.targets:
+            if await target.is_available():
+                return True
+        return False
+
+    async def _get_deployment_info(self, function_name):
+        deployment_info = self.deployment_cache.get(function_name)
+        if deployment_info:
+            return deployment_info
+        url = self._build_url('{0}/{1}'.format(self.deployment_list_path, function_name))
+        deployment_info = await self._create_request('GET', url, function_name=function_name)
         if not deployment_info:
             logging.error('Error getting deployment info')
             return None
+        self.deployment_cache.put(deployment_info)
         return deployment_info
 
-    @utils.lazy_property
-    def _kubernetes_version(self):
-        url = 'https://{0}:{1}{2}'.format(self.kubernetes_service_host, self.kubernetes_service_port, self.nodes_info_path)
-        nodes_info = self._create_request('GET', url)
-        if not nodes_info:
-            logging.error('Error getting nodes info')
+    def get_scheduling_settings(self, function_name):
+        # Defaults are used until the function deployment is cached
+        deployment_info = self.deployment_cache.get(function_name)
+        if not deployment_info:
+            return 1.0, 0
+        try:
+            return (float(jobtemplate.get_deployment_setting(deployment_info, scheduler.WEIGHT_LABEL, 1)),
+                    int(jobtemplate.get_deployment_setting(deployment_info, scheduler.MAX_CONCURRENCY_LABEL, 0)))
+        except ValueError:
+            return 1.0, 0
+
+    async def _get_kubernetes_version(self):
+        # Oldest version of the targets, as Jobs can be routed to any of them
+        versions = await asyncio.gather(*[target.get_version() for target in self.targets])
+        if None in versions:
             return None
-        return version.parse(nodes_info['items'][0]['status']['nodeInfo']['kubeletVersion'])
+        return min(versions)
 
-    def _create_job_definition(self, function_name, event, envs):
-        deployment_info = self._get_deployment_info(function_name)
-        container_info = deployment_info['spec']['template']['spec']['containers'][0]
+    async def _is_kubernetes_version_at_least(self, min_version):
+        # Features are disabled while the version is unknown
+        kubernetes_version = await self._get_kubernetes_version()
+        return kubernetes_version is not None and kubernetes_version >= version.parse(min_version)
 
-        # Volumes
-        pod_spec = deployment_info['spec']['template']['spec']
-        if 'volumes' in pod_spec:
-            volumes = pod_spec['volumes']
+    async def _get_job_template(self, function_name, mode=jobtemplate.INLINE):
+        start = time.perf_counter()
+        deployment_info = await self._get_deployment_info(function_name)
+        metrics.STAGE_DURATION.observe(time.perf_counter() - start, function_name, 'deployment_lookup')
+        if not deployment_info:
+            return None
+        resource_version = deployment_info['metadata'].get('resourceVersion')
+        recommendation = None
+        if self.profiler is not None:
+            recommendation = self.profiler.get_recommendation(function_name, deployment_info)
+        key = (function_name, resource_version, mode, recommendation)
+        template = self._job_templates.get(key)
+        if template is None:
+            # Add ttlSecondsAfterFinished option if Kubernetes version is >= 1.12
+            ttl = None
+            if await self._is_kubernetes_version_at_least('v1.12'):
+                ttl = self.job_ttl_seconds_after_finished
+            default_resources = None
+            if recommendation is not None:
+                default_resources = profiler.to_resources(recommendation, self.profiler.defaults)
+            # The namespace depends on the target of each Job
+            template = JobTemplate.from_deployment(deployment_info, jobtemplate.slot('namespace'),
+                                                   self.job_backoff_limit, ttl,
+                                                   mode=mode, default_resources=default_resources,
+                                                   traced=self.tracer is not None)
+            self._job_templates[key] = template
+            while len(self._job_templates) > int(self.deployment_cache_size):
+                self._job_templates.popitem(last=False)
         else:
-            volumes = []
+            self._job_templates.move_to_end(key)
+        return template
 
-        # Set default resources if they are not specified in the deployment
-        if 'resources' in container_info and bool(container_info['resources']):
-            resources = container_info['resources']
-        else:
-            resources = {
-                'requests': {
-                    'memory': '256Mi',
-                    'cpu': '250m'
-                },
-                'limits': {
-                    'memory': '256Mi',
-                    'cpu': '250m'
-                }
-            }
-
-        # Create JSON based on function deployment
-        job = {
-            'apiVersion': 'batch/v1',
-            'kind': 'Job',
+    def _get_job_bucket(self):
+        bucket = int(self.job_gc_bucket)
+        return str(int(time.time()) // bucket * bucket)
+
+    def _create_job_definition(self, template, job_name, envs, **values):
+        return template.render(job_name, envs, bucket=self._get_job_bucket(), **values)
+
+    def _encode_offloaded_event(self, body):
+        # Compress the event only when it saves space
+        raw = base64.b64decode(body)
+        compressed = gzip.compress(raw, compresslevel=1)
+        if len(compressed) < len(raw) * 0.9:
+            return {'event.gz': utils.utf8_to_base64_string(compressed)}
+        return {'event': body}
+
+    def _create_env_file(self, envs):
+        # Shell script exporting the variables of a batched event
+        lines = []
+        for env in envs:
+            if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', env['name']):
+                lines.append('export {0}={1}\n'.format(env['name'], shlex.quote(env['value'])))
+        return utils.utf8_to_base64_string(''.join(lines).encode('utf-8'))
+
+    def _create_event_config_map_definition(self, job_name, job_uid, binary_data, namespace):
+        return {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
             'metadata': {
-                'name': '{0}-{1}'.format(function_name, str(uuid.uuid4())),
-                'namespace': 'oscar-fn',
-            },
-            'spec': {
-                'backoffLimit': int(self.job_backoff_limit),
-                'template': {
-                    'spec': {
-                        'containers': [
-                            {
-                                'name': container_info['name'],
-                                'image': container_info['image'],
-                                'command': ['/bin/sh'],
-                                'args': ['-c', 'echo $EVENT | $fprocess'],
-                                'env': container_info['env'] if 'env' in container_info else [],
-                                'resources': resources,
-                                'volumeMounts': container_info['volumeMounts'] if 'volumeMounts' in container_info else []
-                            }
-                        ],
-                        'volumes': volumes,
-                        'restartPolicy': 'OnFailure'
+                'name': job_name,
+                'namespace': namespace,
+                # Deleted by the garbage collector together with the Job
+                'ownerReferences': [
+                    {
+                        'apiVersion': 'batch/v1',
+                        'kind': 'Job',
+                        'name': job_name,
+                        'uid': job_uid
                     }
-                }
-            }
-        }
-
-        # Add event as an environment variable
-        event_variable = {
-            'name': 'EVENT',
-            'value': str(event)
+                ]
+            },
+            'binaryData': binary_data
         }
-        job['spec']['template']['spec']['containers'][0]['env'].append(event_variable)
-
-        # Add additional environment variables
-        job['spec']['template']['spec']['containers'][0]['env'].extend(envs)
 
-        # Add ttlSecondsAfterFinished option if Kubernetes version is >= 1.12
-        if self._kubernetes_version >= version.parse('v1.12'):
-            job['spec']['ttlSecondsAfterFinished'] = int(self.job_ttl_seconds_after_finished)
+    async def _delete_job(self, target, job_name):
+        url = target._build_url('{0}/{1}?propagationPolicy=Background'.format(target.create_job_path, job_name))
+        await target._create_request('DELETE', url)
 
-        return job
+    async def _offload_events(self, target, job_name, job_uid, binary_data):
+        definition = self._create_event_config_map_definition(job_name, job_uid, binary_data, target.namespace)
+        url = target._build_url(target.create_config_map_path)
+        status, _ = await target._request('POST', url, json=definition)
+        # It may have been created by a previous attempt
+        if status in [201, 409]:
+            return True
+        # The pod can not start without its event
+        await self._delete_job(target, job_name)
+        return False
 
     def _create_additional_envs(self, data):
         envs = []
@@ -179,18 +706,197 @@ class KubernetesClient:
                 envs.append({'name': name, 'value': value[0]})
         return envs
 
-    def launch_job(self, data):
+    async def _submit_job(self, function_name, template, job_name, envs, parallelism=1, binary_data=None,
+                          trace=None, **values):
+        # Wait until the cluster has capacity for the Job
+        if self.admission:
+            requests = (template.requests[0] * parallelism, template.requests[1] * parallelism)
+            await self.admission.admit(function_name, job_name, requests)
+
+        # Try the targets from the best one, failing over while they fail
+        tried = []
+        while True:
+            target = self.router.choose(tried)
+            if target is None:
+                break
+            tried.append(target)
+            created = await self._post_job(target, function_name, template, job_name, envs, binary_data, trace,
+                                           values)
+            if created is not None:
+                if created:
+                    return True
+                break
+        if self.admission:
+            self.admission.release(job_name)
+        return False
+
+    async def _post_job(self, target, function_name, template, job_name, envs, binary_data, trace, values):
+        '''Returns whether the Job was created in 'target', or None if the
+        target failed and the Job should be tried in another one'''
+        # Rendered once admitted, so its posted-at annotation is accurate
+        posted_at = time.time()
+        if trace is not None:
+            values = dict(values, **trace.get_annotations(posted_at))
+        start = time.perf_counter()
+        definition = self._create_job_definition(template, job_name, envs, namespace=target.namespace, **values)
+        metrics.STAGE_DURATION.observe(time.perf_counter() - start, function_name, 'job_build')
+
+        url = target._build_url(target.create_job_path)
+        start = time.perf_counter()
+        target.posting += 1
+        try:
+            status, resp = await target._request('POST', url, data=definition, function_name=function_name)
+        finally:
+            target.posting -= 1
+        latency = time.perf_counter() - start
+        metrics.STAGE_DURATION.observe(latency, function_name, 'job_post')
+        if status in target.failover_statuses:
+            self.router.record_post(target, False)
+            return None
+        if status not in (201, 409):
+            # Rejected definitions say nothing about the health of the target
+            return False
+        self.router.record_post(target, True, latency)
+        if trace is not None:
+            self.tracer.record_submission(trace, job_name, posted_at, time.time())
+        if status == 409:
+            # The Job name is kept across retries, so it was already created
+            logging.info('Job {0} already exists'.format(job_name))
+            metrics.EVENTS_DEDUPLICATED.inc(function_name)
+            resp = await target._create_request('GET', target._build_url('{0}/{1}'.format(target.create_job_path,
+                                                                                          job_name)))
+        if resp and (binary_data is None or
+                     await self._offload_events(target, job_name, resp['metadata']['uid'], binary_data)):
+            logging.info('Job {0} created successfully'.format(job_name))
+            return True
+        return False
+
+    async def _launch_batch(self, function_name, items):
+        # Indexed Jobs are enabled by default since Kubernetes 1.22 (in 1.21
+        # the feature gate is off and completionMode is dropped)
+        if await self._is_kubernetes_version_at_least('v1.22'):
+            mode = jobtemplate.INDEXED
+        else:
+            mode = jobtemplate.SEQUENTIAL
+        template = await self._get_job_template(function_name, mode)
+        if not template:
+            return False
+        binary_data = {}
+        for index, (body, env_file, _) in enumerate(items):
+            binary_data['event-{0}'.format(index)] = body
+            binary_data['env-{0}'.format(index)] = env_file
+        # Named after its events, unless some of them can not be identified
+        event_keys = [event_key for _, _, event_key in items]
+        batch_key = None
+        if all(event_keys):
+            batch_key = hashlib.sha256(''.join(event_keys).encode('ascii')).hexdigest()[:32]
+        job_name = self._get_job_name(function_name, batch_key)
+        parallelism = len(items) if mode == jobtemplate.INDEXED else 1
+        # The trace of a batch starts when it is flushed
+        trace = None
+        if self.tracer is not None:
+            trace = Trace(function_name, time.time())
+        logging.info('Launching batch of {0} events for function {1}'.format(len(items), function_name))
+        return await self._submit_job(function_name, template, job_name, [], parallelism, binary_data,
+                                      trace=trace, completions=len(items))
+
+    def _get_job_name(self, function_name, event_key):
+        # Redeliveries of identified events get the same Job name, so the
+        # API server rejects them (409) even after a worker restart
+        return '{0}-{1}'.format(function_name, event_key or str(uuid.uuid4()))
+
+    def _remember_event(self, event_key):
+        if event_key is not None:
+            self.dedup_cache.add(event_key)
+
+    async def launch_job(self, data, warm=True):
+        if await self._launch_job(data, warm):
+            return True
+        # Keep the event on disk while the API server is unavailable instead
+        # of leaving it to the queue redeliveries
+        if self.spool is not None and not await self._is_api_available():
+            logging.warning('Kubernetes API unavailable, spooling event for function {0}'.format(data['Function']))
+            return await self.spool.append(data)
+        return False
+
+    async def _launch_fallback(self, data):
+        # Events failed in a warm executor are only retried as Jobs
+        return await self.launch_job(data, warm=False)
+
+    async def launch_jobs(self, events):
+        '''Launches a batch of events, returning the result of each one'''
+        return await asyncio.gather(*[self.launch_job(data) for data in events])
+
+    async def _launch_job(self, data, warm=True):
+        data = Event.wrap(data)
         function_name = data['Function']
-        # Decode data body (OpenFaaS Gateway encodes it to base64)
-        event = utils.base64_to_utf8_string(data['Body'])
+        event_key = None
+        if self.dedup_cache is not None:
+            event_key = self.dedup_cache.get_key(data)
+            if event_key is not None and event_key in self.dedup_cache:
+                logging.info('Discarding duplicated event for function {0}'.format(function_name))
+                metrics.EVENTS_DEDUPLICATED.inc(function_name)
+                return True
+
+        # Hot functions are served by their warm executors when one is idle.
+        # The event is not remembered yet: if the executor fails, it falls
+        # back to a Job and must not be discarded as a duplicate
+        if warm and self.warm_pool is not None:
+            deployment_info = await self._get_deployment_info(function_name)
+            if deployment_info and self.warm_pool.dispatch(deployment_info, data):
+                return True
 
-        logging.info('EVENT RECEIVED: {0}'.format(event))
+        if await self._start_event(data, event_key):
+            self._remember_event(event_key)
+            return True
+        return False
+
+    async def _start_event(self, data, event_key):
+        function_name = data['Function']
+        # Large events are passed to the Job through a ConfigMap, which
+        # already takes them base64 encoded as sent by the OpenFaaS Gateway
+        offload = data.size > int(self.event_offload_threshold)
 
         # Create additional environment variables
         envs = self._create_additional_envs(data)
 
-        definition = self._create_job_definition(function_name, event, envs)
-        url = 'https://{0}:{1}{2}'.format(self.kubernetes_service_host, self.kubernetes_service_port, self.create_job_path)
-        resp = self._create_request('POST', url, json=definition)
-        if resp:
-            logging.info('Job {0} created successfully'.format(definition['metadata']['name']))
+        template = await self._get_job_template(function_name, jobtemplate.OFFLOAD if offload else jobtemplate.INLINE)
+        if not template:
+            return False
+
+        # Coalesce small events of functions with batching enabled
+        if template.batch_size > 1 and not offload:
+            logging.info('EVENT RECEIVED: {0} bytes (batched)'.format(data.size))
+            # The variables are stored next to the event in the ConfigMap
+            env_file = self._create_env_file(envs)
+            return await self.batcher.add(function_name, (data['Body'], env_file, event_key),
+                                          len(data['Body']) + len(env_file),
+                                          template.batch_size, template.batch_linger)
+
+        if offload:
+            event = None
+            logging.info('EVENT RECEIVED: {0} bytes (offloaded)'.format(data.size))
+            binary_data = self._encode_offloaded_event(data['Body'])
+            if sum(len(value) for value in binary_data.values()) > self.max_config_map_data:
+                # It would never fit, so it is discarded instead of retried
+                logging.error('Discarding event for function {0}: it exceeds the maximum size'.format(function_name))
+                return True
+        else:
+            # Decode data body (OpenFaaS Gateway encodes it to base64)
+            start = time.perf_counter()
+            event = data.text
+            metrics.STAGE_DURATION.observe(time.perf_counter() - start, function_name, 'base64_decode')
+            binary_data = None
+            # Only a preview of some events, large bodies would flood the logs
+            if should_log(float(self.event_log_sample_rate)):
+                logging.info('EVENT RECEIVED: {0}'.format(data.preview(int(self.event_log_preview_bytes))))
+
+        # Add event as an environment variable followed by the additional ones
+        if event is not None:
+            envs = [{'name': 'EVENT', 'value': str(event)}] + envs
+        job_name = self._get_job_name(function_name, event_key)
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.start_trace(data)
+        return await self._submit_job(function_name, template, job_name, envs, binary_data=binary_data,
+                                      trace=trace)
@@ -0,0 +1,296 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import bisect
+import collections
+import logging
+import aiohttp
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if not self.labelnames and self.type != 'histogram':
+            self._values[()] = 0
+        REGISTRY.append(self)
+
+    def _samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def expose(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        for name, labels, value in self._samples():
+            lines.append('{0}{1} {2}'.format(name, labels, repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # [bucket counts..., +Inf count, sum]
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def _samples(self):
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = 'le="{0}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                yield self.name + '_bucket', _format_labels(self.labelnames, labels, le), cumulative
+            yield self.name + '_count', _format_labels(self.labelnames, labels), cumulative
+            yield self.name + '_sum', _format_labels(self.labelnames, labels), series[-1]
+
+
+REGISTRY = []
+
+
+def expose():
+    return '\n'.join(metric.expose() for metric in REGISTRY) + '\n'
+
+
+def merge_expositions(expositions):
+    '''Merges the metrics exposed by several processes, given as a list of
+    (worker index, text) pairs, adding a 'worker' label to their samples'''
+    families = collections.OrderedDict()
+    for index, text in expositions:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('#'):
+                parts = line.split(' ', 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    family = families.setdefault(parts[2], ([], []))
+                    if line not in family[0]:
+                        family[0].append(line)
+                continue
+            if family is None:
+                continue
+            name_end = min(position for position in (line.find('{'), line.find(' ')) if position >= 0)
+            label = 'worker="{0}"'.format(index)
+            if line[name_end] == '{':
+                closing = '' if line[name_end + 1] == '}' else ','
+                line = line[:name_end + 1] + label + closing + line[name_end + 1:]
+            else:
+                line = line[:name_end] + '{' + label + '}' + line[name_end:]
+            family[1].append(line)
+    return ''.join('\n'.join(headers + samples) + '\n' for headers, samples in families.values())
+
+
+# Worker metrics
+EVENTS_RECEIVED = Counter('oscar_worker_events_received_total',
+                          'Events received from the queue')
+EVENTS_IN_FLIGHT = Gauge('oscar_worker_events_in_flight',
+                         'Events being processed')
+EVENTS_PROCESSED = Counter('oscar_worker_events_processed_total',
+                           'Events processed by function and result',
+                           ['function', 'result'])
+EVENTS_DEDUPLICATED = Counter('oscar_worker_events_deduplicated_total',
+                              'Redelivered events that were already launched',
+                              ['function'])
+STAGE_DURATION = Histogram('oscar_worker_stage_duration_seconds',
+                           'Time spent on each stage of the event processing',
+                           ['function', 'stage'])
+KUBERNETES_REQUESTS = Counter('oscar_worker_kubernetes_requests_total',
+                              'Requests to the Kubernetes API by method and status code',
+                              ['function', 'method', 'code'])
+KUBERNETES_REQUEST_DURATION = Histogram('oscar_worker_kubernetes_request_duration_seconds',
+                                        'Latency of the requests to the Kubernetes API',
+                                        ['method'])
+KUBERNETES_RETRIES = Counter('oscar_worker_kubernetes_retries_total',
+                             'Retried requests to the Kubernetes API',
+                             ['method'])
+KUBERNETES_RATE_LIMIT = Gauge('oscar_worker_kubernetes_rate_limit',
+                              'Current requests per second allowed to the Kubernetes API')
+KUBERNETES_REQUESTS_IN_FLIGHT = Gauge('oscar_worker_kubernetes_requests_in_flight',
+                                      'Requests to the Kubernetes API waiting for a response')
+ADMISSION_QUEUE_LENGTH = Gauge('oscar_worker_admission_queue_length',
+                               'Events waiting for cluster capacity')
+JOBS_COLLECTED = Counter('oscar_worker_jobs_collected_total',
+                         'Finished Jobs deleted by the worker')
+SCHEDULER_QUEUE_LENGTH = Gauge('oscar_worker_scheduler_queue_length',
+                               'Events of each function waiting for a launch slot',
+                               ['function'])
+WARM_POOL_SIZE = Gauge('oscar_worker_warm_pool_size',
+                       'Desired executors of the warm pool of each function',
+                       ['function'])
+WARM_POOL_EVENTS = Counter('oscar_worker_warm_pool_events_total',
+                           'Events of warm pool functions by result (dispatched, saturated or failed)',
+                           ['function', 'result'])
+SPOOL_EVENTS = Gauge('oscar_worker_spool_events',
+                     'Events stored in the local spool waiting to be replayed')
+SPOOL_BYTES = Gauge('oscar_worker_spool_bytes',
+                    'Size of the events stored in the local spool')
+SPOOL_OLDEST_EVENT_AGE = Gauge('oscar_worker_spool_oldest_event_age_seconds',
+                               'Age of the oldest event stored in the local spool')
+SPOOL_REPLAYED = Counter('oscar_worker_spool_replayed_total',
+                         'Spooled events replayed by result',
+                         ['result'])
+FUNCTION_POD_TERMINATIONS = Counter('oscar_worker_function_pod_terminations_total',
+                                    'Finished Job pods by function, reason and exit code',
+                                    ['function', 'reason', 'exit_code'])
+FUNCTION_POD_DURATION = Histogram('oscar_worker_function_pod_duration_seconds',
+                                  'Running time of the finished Job pods',
+                                  ['function'],
+                                  buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+INVOCATION_STAGE_DURATION = Histogram('oscar_worker_invocation_stage_duration_seconds',
+                                      'Duration of the stages of the traced invocations by function',
+                                      ['function', 'stage'],
+                                      buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+                                               1800, 3600))
+TARGET_HEALTHY = Gauge('oscar_worker_target_healthy',
+                       'Whether each Kubernetes target receives Jobs',
+                       ['target'])
+TARGET_ACTIVE_JOBS = Gauge('oscar_worker_target_active_jobs',
+                           'Unfinished Jobs of each Kubernetes target',
+                           ['target'])
+TARGET_PENDING_PODS = Gauge('oscar_worker_target_pending_pods',
+                            'Pending Job pods of each Kubernetes target',
+                            ['target'])
+JOBS_ROUTED = Counter('oscar_worker_jobs_routed_total',
+                      'Job posts accepted by each Kubernetes target',
+                      ['target'])
+RIGHTSIZING_RECOMMENDATION = Gauge('oscar_worker_rightsizing_recommendation',
+                                   'Recommended Job resources (cores or bytes) by function',
+                                   ['function', 'resource'])
+
+
+class MetricsServer:
+    '''HTTP server exposing the worker metrics in the Prometheus text format
+    and its health and readiness probes, served from the worker event loop.
+
+    'readiness' is a callable returning whether the worker is ready.'''
+
+    def __init__(self, port, readiness=None):
+        self.port = port
+        self.readiness = readiness
+        self.app = web.Application()
+        self.app.router.add_get('/metrics', self._metrics)
+        self.app.router.add_get('/healthz', self._healthz)
+        self.app.router.add_get('/ready', self._ready)
+        self._runner = None
+
+    async def _metrics(self, request):
+        return web.Response(text=expose(), content_type='text/plain', charset='utf-8')
+
+    async def _healthz(self, request):
+        return web.Response(text='OK')
+
+    async def _ready(self, request):
+        if self.readiness is None or self.readiness():
+            return web.Response(text='OK')
+        return web.Response(text='Warming up', status=503)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, port=self.port).start()
+        logging.info('Serving metrics on port {0}'.format(self.port))
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class MetricsAggregator(MetricsServer):
+    '''Serves the merged metrics of the worker processes, which expose them in
+    'worker_ports', and is only ready when all of them are.'''
+
+    timeout = 5
+
+    def __init__(self, port, worker_ports):
+        super().__init__(port)
+        self.worker_ports = worker_ports
+        self._session = None
+
+    async def _fetch(self, port, path):
+        # Returns the status and body of the request (None if unreachable)
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        try:
+            async with self._session.get('http://127.0.0.1:{0}{1}'.format(port, path)) as resp:
+                return resp.status, await resp.text()
+        except Exception:
+            return None, None
+
+    async def _metrics(self, request):
+        responses = await asyncio.gather(*[self._fetch(port, '/metrics') for port in self.worker_ports])
+        # Processes being restarted are left out
+        text = merge_expositions([(index, body) for index, (status, body) in enumerate(responses) if status == 200])
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    async def _ready(self, request):
+        responses = await asyncio.gather(*[self._fetch(port, '/ready') for port in self.worker_ports])
+        not_ready = [str(index) for index, (status, _) in enumerate(responses) if status != 200]
+        if not not_ready:
+            return web.Response(text='OK')
+        return web.Response(text='Workers not ready: {0}'.format(', '.join(not_ready)), status=503)
+
+    async def close(self):
+        await super().close()
+        if self._session is not None:
+            await self._session.close()
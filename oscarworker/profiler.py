@@ -0,0 +1,328 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import math
+import time
+import oscarworker.metrics as metrics
+import oscarworker.utils as utils
+from oscarworker.jobtemplate import FUNCTION_LABEL, get_deployment_setting
+
+# Deployment annotation (or label) set to 'false' to keep the default resources
+RIGHTSIZING_ANNOTATION = 'oscar.grycap/rightsizing'
+
+# Recommended (cpu request, cpu limit, memory request, memory limit), None
+# when there are not enough samples of a resource
+Recommendation = collections.namedtuple('Recommendation', ['cpu_request', 'cpu_limit',
+                                                           'memory_request', 'memory_limit'])
+
+
+def format_cpu(value):
+    return '{0}m'.format(int(math.ceil(value * 1000)))
+
+def format_memory(value):
+    return '{0}Mi'.format(int(math.ceil(value / 2 ** 20)))
+
+
+class DecayingHistogram:
+    '''Histogram with exponentially growing buckets (each 'ratio' times the
+    previous one) whose samples lose half of their weight every 'half_life'
+    seconds, so percentiles follow the recent behaviour of the function.'''
+
+    ratio = 1.05
+    # Buckets with a negligible share of the total weight are dropped
+    min_share = 1e-5
+
+    def __init__(self, first_bucket, half_life):
+        self.first_bucket = first_bucket
+        self.half_life = half_life
+        # bucket index -> weight (relative to the reference time)
+        self._weights = {}
+        self._reference = time.time()
+        self.total = 0.0
+        # Samples added (without decay)
+        self.samples = 0
+
+    def _index(self, value):
+        if value <= self.first_bucket:
+            return 0
+        return int(math.ceil(math.log(value / self.first_bucket, self.ratio)))
+
+    def add(self, value, timestamp=None):
+        timestamp = timestamp or time.time()
+        exponent = (timestamp - self._reference) / self.half_life
+        if exponent > 100:
+            # Move the reference forward before the weights overflow
+            scale = 2 ** -exponent
+            self._weights = {index: weight * scale for index, weight in self._weights.items()
+                             if weight * scale > 0}
+            self.total *= scale
+            self._reference = timestamp
+            exponent = 0
+        weight = 2 ** exponent
+        index = self._index(value)
+        self._weights[index] = self._weights.get(index, 0.0) + weight
+        self.total += weight
+        self.samples += 1
+        if len(self._weights) > 64:
+            self._prune()
+
+    def _prune(self):
+        threshold = self.total * self.min_share
+        for index in [index for index, weight in self._weights.items() if weight < threshold]:
+            self.total -= self._weights.pop(index)
+
+    def percentile(self, percentile):
+        '''Upper bound of the bucket holding the given percentile (0-1)'''
+        if not self._weights:
+            return None
+        threshold = self.total * percentile
+        accumulated = 0.0
+        for index in sorted(self._weights):
+            accumulated += self._weights[index]
+            if accumulated >= threshold:
+                break
+        return self.first_bucket * self.ratio ** index
+
+
+class FunctionProfile:
+    '''Resource usage of the finished pods of a function'''
+
+    def __init__(self, half_life):
+        self.cpu = DecayingHistogram(0.001, half_life)
+        self.memory = DecayingHistogram(2 ** 20, half_life)
+        # Memory limit (bumped) of the last OOM killed pod and its time
+        self.oom_memory = 0.0
+        self.last_oom = 0.0
+        self.recommendation = None
+        # Samples and OOM kills the recommendation was computed from
+        self.computed = None
+
+    def get_state(self):
+        return self.cpu.samples, self.memory.samples, self.last_oom
+
+
+class PodState:
+
+    def __init__(self, name, function_name, memory_limit):
+        self.name = name
+        self.function_name = function_name
+        self.memory_limit = memory_limit
+        self.restarts = 0
+        self.peak_memory = 0.0
+
+
+class ResourceProfiler:
+    '''Recommends the resources of the Jobs of functions that do not set
+    them, from the pods they ran before.
+
+    Finished pods report their duration, exit code and OOM kills. When the
+    metrics API is available its CPU and memory usage is sampled every
+    'metrics_interval' seconds: CPU samples and the peak memory of each pod
+    feed per-function decaying histograms. Requests and limits are taken
+    from the 'request_percentile' and 'limit_percentile' of the histograms
+    (plus a 'margin'), and memory limits are raised above the limits of OOM
+    killed pods. Recommendations only change when they differ more than
+    'tolerance' from the current ones, so Job templates are not recompiled
+    on every sample.'''
+
+    oom_bump = 1.2
+    min_oom_bump = 100 * 2 ** 20
+    tolerance = 0.1
+    # Finished pods remembered to skip them when they are listed again
+    max_finished = 10000
+
+    def __init__(self, kube_client, namespace, defaults, request_percentile=0.9, limit_percentile=0.99,
+                 margin=1.15, min_samples=10, half_life=24 * 3600, bounds=((0.01, 4.0), (32 * 2 ** 20, 8 * 2 ** 30)),
+                 metrics_interval=15):
+        self.kube_client = kube_client
+        self.metrics_path = '/apis/metrics.k8s.io/v1beta1/namespaces/{0}/pods'.format(namespace)
+        # Default resources of the Jobs as (cpu request, cpu limit, memory request, memory limit)
+        self.defaults = defaults
+        self.request_percentile = request_percentile
+        self.limit_percentile = limit_percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.half_life = half_life
+        # ((min cpu, max cpu), (min memory, max memory))
+        self.bounds = bounds
+        self.metrics_interval = metrics_interval
+        self._profiles = {}
+        self._pods = {}
+        self._finished = collections.OrderedDict()
+
+    def _get_profile(self, function_name):
+        profile = self._profiles.get(function_name)
+        if profile is None:
+            profile = self._profiles[function_name] = FunctionProfile(self.half_life)
+        return profile
+
+    def _record_oom(self, state):
+        if not state.memory_limit:
+            return
+        profile = self._get_profile(state.function_name)
+        memory = max(state.memory_limit * self.oom_bump, state.memory_limit + self.min_oom_bump)
+        # The bump of an old OOM expires after a half-life
+        if memory > profile.oom_memory or time.time() - profile.last_oom > self.half_life:
+            profile.oom_memory = memory
+        profile.last_oom = time.time()
+        profile.memory.add(memory)
+        logging.warning('Pod of function "{0}" OOM killed with a memory limit of {1}'.format(
+            state.function_name, format_memory(state.memory_limit)))
+
+    def _finish(self, uid, pod, container_status):
+        state = self._pods.pop(uid, None)
+        self._finished[uid] = True
+        while len(self._finished) > self.max_finished:
+            self._finished.popitem(last=False)
+        if state is None:
+            return
+        terminated = container_status['state']['terminated']
+        reason = terminated.get('reason') or 'Unknown'
+        metrics.FUNCTION_POD_TERMINATIONS.inc(state.function_name, reason, str(terminated.get('exitCode')))
+        if reason == 'OOMKilled':
+            self._record_oom(state)
+        elif state.peak_memory:
+            self._get_profile(state.function_name).memory.add(state.peak_memory)
+        start = pod['status'].get('startTime')
+        if start and terminated.get('finishedAt'):
+            metrics.FUNCTION_POD_DURATION.observe(utils.parse_time(terminated['finishedAt']) - utils.parse_time(start),
+                                                  state.function_name)
+
+    def _update_pod(self, event_type, pod):
+        uid = pod['metadata']['uid']
+        if uid in self._finished:
+            return
+        state = self._pods.get(uid)
+        if state is None:
+            function_name = pod['metadata'].get('labels', {}).get(FUNCTION_LABEL)
+            if not function_name:
+                return
+            limits = pod['spec']['containers'][0].get('resources', {}).get('limits', {})
+            state = self._pods[uid] = PodState(pod['metadata']['name'], function_name, utils.parse_quantity(limits.get('memory', 0)))
+        status = pod.get('status', {})
+        for container_status in status.get('containerStatuses') or []:
+            # Containers restarted after an OOM kill (restartPolicy: OnFailure)
+            last_state = container_status.get('lastState', {}).get('terminated')
+            if container_status.get('restartCount', 0) > state.restarts:
+                state.restarts = container_status['restartCount']
+                if last_state and last_state.get('reason') == 'OOMKilled':
+                    self._record_oom(state)
+            if status.get('phase') in ('Succeeded', 'Failed') and \
+                    'terminated' in container_status.get('state', {}):
+                self._finish(uid, pod, container_status)
+                return
+        if event_type == 'DELETED':
+            self._pods.pop(uid, None)
+
+    def resync(self, pods):
+        for pod in pods:
+            self._update_pod('ADDED', pod)
+
+    def update(self, event_type, pod):
+        self._update_pod(event_type, pod)
+
+    def _add_usage(self, usages):
+        # Pod metrics only identify the pods by name
+        memory_usage = {}
+        for usage in usages:
+            function_name = usage['metadata'].get('labels', {}).get(FUNCTION_LABEL)
+            containers = usage.get('containers') or []
+            if not function_name or not containers:
+                continue
+            cpu = sum(utils.parse_quantity(container['usage'].get('cpu', 0)) for container in containers)
+            memory = sum(utils.parse_quantity(container['usage'].get('memory', 0)) for container in containers)
+            self._get_profile(function_name).cpu.add(cpu)
+            memory_usage[usage['metadata']['name']] = memory
+        for state in self._pods.values():
+            if state.name in memory_usage:
+                state.peak_memory = max(state.peak_memory, memory_usage[state.name])
+
+    async def _poll_metrics(self):
+        url = self.kube_client._build_url('{0}?labelSelector={1}'.format(self.metrics_path, FUNCTION_LABEL))
+        # Single attempt, a missed sample is taken on the next interval
+        status, body, _ = await self.kube_client._send_request('GET', url, None, None, None, '')
+        if status in (403, 404):
+            logging.warning('Pod metrics not available, only OOM kills are used to size the Jobs')
+            return False
+        if status == 200:
+            self._add_usage(body.get('items') or [])
+        return True
+
+    def _recommend(self, histogram, default_request, default_limit, bounds, floor=0.0):
+        if histogram.samples < self.min_samples:
+            if floor > default_limit:
+                floor = min(floor, bounds[1])
+                return floor, floor
+            return None, None
+        request = histogram.percentile(self.request_percentile) * self.margin
+        limit = histogram.percentile(self.limit_percentile) * self.margin
+        request = min(max(request, bounds[0]), bounds[1])
+        limit = min(max(limit, request, floor, bounds[0]), bounds[1])
+        return request, limit
+
+    def _changed(self, current, value):
+        if current is None or value is None:
+            return current != value
+        return abs(value - current) > current * self.tolerance
+
+    def get_recommendation(self, function_name, deployment_info):
+        '''Returns the Recommendation for the Jobs of the function, or None to
+        use the default resources'''
+        if str(get_deployment_setting(deployment_info, RIGHTSIZING_ANNOTATION, 'true')).lower() == 'false':
+            return None
+        profile = self._profiles.get(function_name)
+        if profile is None:
+            return None
+        if profile.computed == profile.get_state():
+            return profile.recommendation
+        profile.computed = profile.get_state()
+        cpu_request, cpu_limit, memory_request, memory_limit = self.defaults
+        oom_memory = profile.oom_memory if time.time() - profile.last_oom < self.half_life else 0.0
+        values = (self._recommend(profile.cpu, cpu_request, cpu_limit, self.bounds[0]) +
+                  self._recommend(profile.memory, memory_request, memory_limit, self.bounds[1], oom_memory))
+        if all(value is None for value in values):
+            return None
+        current = profile.recommendation
+        if current is None or any(self._changed(old, new) for old, new in zip(current, values)):
+            profile.recommendation = Recommendation(*values)
+            logging.info('Resources of function "{0}": {1}'.format(function_name, to_resources(
+                profile.recommendation, self.defaults)))
+            for resource, value in profile.recommendation._asdict().items():
+                if value is not None:
+                    metrics.RIGHTSIZING_RECOMMENDATION.set(value, function_name, resource)
+        return profile.recommendation
+
+    async def run(self):
+        if not self.metrics_interval:
+            return
+        while True:
+            try:
+                if not await self._poll_metrics():
+                    return
+            except Exception as ex:
+                logging.error('Error getting pod metrics: {0}'.format(str(ex)))
+            await asyncio.sleep(self.metrics_interval)
+
+
+def to_resources(recommendation, defaults):
+    '''Container resources of a Recommendation, completed with the defaults'''
+    values = [default if value is None else value for value, default in zip(recommendation, defaults)]
+    return {
+        'requests': {'cpu': format_cpu(values[0]), 'memory': format_memory(values[2])},
+        'limits': {'cpu': format_cpu(values[1]), 'memory': format_memory(values[3])}
+    }
@@ -0,0 +1,68 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+
+class AdaptiveRateLimiter:
+    '''Token bucket in front of the Kubernetes API requests whose rate adapts
+    to what the API server accepts: it grows while requests succeed and is
+    reduced to 70% when the server throttles them. Like TCP slow start, the
+    rate doubles every second until the first throttled request.'''
+
+    # Minimum requests per second and ratio of the current rate added each
+    # second while there is no throttling
+    increase_step = 5.0
+    increase_ratio = 0.1
+    slow_start_ratio = 1.0
+    decrease_factor = 0.7
+
+    def __init__(self, rate, burst, min_rate=1.0, max_rate=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate) if max_rate else self.rate
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._slow_start = True
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        # Tokens are taken in advance, so each request just sleeps until its
+        # turn and waiting requests are served in order
+        self._refill(time.monotonic())
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def on_success(self):
+        # Each success adds a fraction of the per second increase
+        ratio = self.slow_start_ratio if self._slow_start else self.increase_ratio
+        increase = max(self.increase_step, self.rate * ratio)
+        self.rate = min(self.max_rate, self.rate + increase / self.rate)
+
+    def on_throttle(self):
+        now = time.monotonic()
+        self._slow_start = False
+        # Concurrent rejections of the same overload only reduce the rate once
+        if now - self._last_decrease > 1.0:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+            self._last_decrease = now
@@ -0,0 +1,127 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import collections
+import logging
+import time
+import oscarworker.metrics as metrics
+
+# Deployment labels (or annotations) with the scheduling settings of a function
+WEIGHT_LABEL = 'oscar.grycap/weight'
+MAX_CONCURRENCY_LABEL = 'oscar.grycap/max-concurrency'
+
+MIN_WEIGHT = 0.01
+
+
+class FairScheduler:
+    '''Per-function queues served with deficit round robin.
+
+    Each function with queued events receives 'weight' credits on its turn
+    and launches one event per credit, so a burst of one function can only
+    take its share of the 'concurrency' launch slots. Functions may also
+    cap their own concurrent launches.
+
+    'handler' is the coroutine launching an event and 'get_settings' returns
+    the (weight, max_concurrency) of a function, 0 meaning no cap.'''
+
+    def __init__(self, handler, concurrency, get_settings):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.get_settings = get_settings
+        self._queues = {}
+        self._active = collections.deque()
+        self._deficits = {}
+        # Whether the function at the head of '_active' got its credits
+        self._turn = False
+        self._running = collections.Counter()
+        self._total_running = 0
+
+    async def submit(self, data):
+        '''Queues the event and returns the handler result once launched'''
+        function_name = data.get('Function', '')
+        queue = self._queues.get(function_name)
+        if queue is None:
+            queue = self._queues[function_name] = collections.deque()
+            self._deficits[function_name] = 0.0
+            self._active.append(function_name)
+        future = asyncio.get_event_loop().create_future()
+        queue.append((data, future, time.perf_counter()))
+        metrics.SCHEDULER_QUEUE_LENGTH.set(len(queue), function_name)
+        self._dispatch()
+        return await future
+
+    async def submit_batch(self, events):
+        '''Queues a batch of events and returns their handler results'''
+        return await asyncio.gather(*[self.submit(data) for data in events])
+
+    def _end_turn(self):
+        self._active.rotate(-1)
+        self._turn = False
+
+    def _select(self):
+        blocked = 0
+        while self._active and blocked < len(self._active):
+            function_name = self._active[0]
+            weight, max_concurrency = self.get_settings(function_name)
+            if max_concurrency and self._running[function_name] >= max_concurrency:
+                # Capped functions give up their turn without credits
+                self._end_turn()
+                blocked += 1
+                continue
+            if not self._turn:
+                self._deficits[function_name] += max(weight, MIN_WEIGHT)
+                self._turn = True
+            if self._deficits[function_name] >= 1:
+                self._deficits[function_name] -= 1
+                return function_name
+            self._end_turn()
+        return None
+
+    def _dispatch(self):
+        while self._total_running < self.concurrency:
+            function_name = self._select()
+            if function_name is None:
+                break
+            queue = self._queues[function_name]
+            data, future, enqueued = queue.popleft()
+            metrics.SCHEDULER_QUEUE_LENGTH.set(len(queue), function_name)
+            if not queue:
+                # Idle functions do not keep credits
+                del self._queues[function_name]
+                del self._deficits[function_name]
+                self._active.popleft()
+                self._turn = False
+            if future.cancelled():
+                continue
+            metrics.STAGE_DURATION.observe(time.perf_counter() - enqueued, function_name, 'queue_wait')
+            self._running[function_name] += 1
+            self._total_running += 1
+            asyncio.ensure_future(self._run(function_name, data, future))
+
+    async def _run(self, function_name, data, future):
+        try:
+            result = await self.handler(data)
+            if not future.done():
+                future.set_result(result)
+        except Exception as ex:
+            logging.error('Error launching event of function {0}: {1}'.format(function_name, str(ex)))
+            if not future.done():
+                future.set_result(False)
+        finally:
+            self._running[function_name] -= 1
+            if not self._running[function_name]:
+                del self._running[function_name]
+            self._total_running -= 1
+            self._dispatch()
@@ -0,0 +1,299 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+import oscarworker.metrics as metrics
+import oscarworker.utils as utils
+
+
+class EventSpool:
+    '''Durable write-ahead log of the events whose Job could not be created.
+
+    Events are appended to segment files as length and CRC prefixed records
+    and fsynced in batches, so an append only returns once the event is on
+    disk. Replayed records are acknowledged in a companion '.ack' file per
+    segment. Fully acknowledged segments are deleted and mostly acknowledged
+    ones are compacted by moving their pending records to the active one.'''
+
+    header = struct.Struct('<II')
+    ack_format = struct.Struct('<Q')
+    segment_size = 16 * 1024 * 1024
+    compaction_ratio = 0.5
+    max_backoff = 60
+
+    def __init__(self, path, max_bytes, fsync_interval=0.01, drain_concurrency=8, max_attempts=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.drain_concurrency = drain_concurrency
+        self.max_attempts = max_attempts
+        # (segment, offset) -> [record size, timestamp, attempts], oldest first
+        self._records = collections.OrderedDict()
+        # segment -> [records, acknowledged records]
+        self._segments = {}
+        self._replaying = set()
+        # Consecutive failed replays
+        self._failures = 0
+        self._active = None
+        self._active_file = None
+        self._active_size = 0
+        self._ack_files = {}
+        self._buffer = []
+        self._flush_handle = None
+        self._flush_lock = asyncio.Lock()
+        self.size = 0
+
+    def _segment_path(self, segment, extension='log'):
+        return os.path.join(self.path, '{0:020d}.{1}'.format(segment, extension))
+
+    def open(self):
+        '''Loads the pending records of the existing segments'''
+        utils.create_folder(self.path)
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+        for segment in segments:
+            self._load_segment(segment)
+        self._open_segment(segments[-1] + 1 if segments else 0)
+        if self._records:
+            logging.info('Spool loaded with {0} pending events'.format(len(self._records)))
+        self._update_metrics()
+
+    def _load_segment(self, segment):
+        acked = set()
+        ack_path = self._segment_path(segment, 'ack')
+        if os.path.isfile(ack_path):
+            content = utils.read_file(ack_path, 'rb')
+            for i in range(0, len(content) - self.ack_format.size + 1, self.ack_format.size):
+                acked.add(self.ack_format.unpack_from(content, i)[0])
+        content = utils.read_file(self._segment_path(segment), 'rb')
+        offset = 0
+        records = 0
+        pending = 0
+        while offset + self.header.size <= len(content):
+            length, crc = self.header.unpack_from(content, offset)
+            payload = content[offset + self.header.size:offset + self.header.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            records += 1
+            if offset not in acked:
+                timestamp = json.loads(payload.decode('utf-8'))['timestamp']
+                self._records[(segment, offset)] = [self.header.size + length, timestamp, 0]
+                self.size += self.header.size + length
+                pending += 1
+            offset += self.header.size + length
+        if offset < len(content):
+            # Drop the incomplete record of an interrupted write
+            logging.warning('Truncating corrupted spool segment {0} at {1}'.format(segment, offset))
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.truncate(offset)
+        self._segments[segment] = [records, records - pending]
+        self._delete_segment_if_done(segment)
+
+    def _open_segment(self, segment):
+        if self._active_file:
+            self._active_file.close()
+        self._active = segment
+        self._active_file = open(self._segment_path(segment), 'ab')
+        self._active_size = self._active_file.tell()
+        self._segments.setdefault(segment, [0, 0])
+
+    def _delete_segment_if_done(self, segment):
+        records, acked = self._segments[segment]
+        if segment != self._active and acked >= records:
+            ack_file = self._ack_files.pop(segment, None)
+            if ack_file:
+                ack_file.close()
+            utils.delete_file(self._segment_path(segment))
+            utils.delete_file(self._segment_path(segment, 'ack'))
+            del self._segments[segment]
+
+    def close(self):
+        for ack_file in self._ack_files.values():
+            ack_file.close()
+        self._ack_files = {}
+        if self._active_file:
+            self._active_file.close()
+            self._active_file = None
+
+    def __len__(self):
+        return len(self._records)
+
+    async def append(self, data):
+        '''Durably stores 'data', returning False if the spool is full'''
+        timestamp = time.time()
+        payload = json.dumps({'timestamp': timestamp, 'data': data}).encode('utf-8')
+        record = self.header.pack(len(payload), zlib.crc32(payload)) + payload
+        if self.size + len(record) > self.max_bytes:
+            logging.error('Spool is full, the event can not be stored')
+            return False
+        return await self._enqueue(record, timestamp)
+
+    async def _enqueue(self, record, timestamp, attempts=0):
+        self.size += len(record)
+        future = asyncio.get_event_loop().create_future()
+        self._buffer.append((record, future, timestamp, attempts))
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.fsync_interval, lambda: asyncio.ensure_future(self._flush()))
+        return await future
+
+    def _write(self, records):
+        # Runs in a thread: appends the records and fsyncs them at once
+        offsets = []
+        for record in records:
+            offsets.append((self._active, self._active_size))
+            self._active_file.write(record)
+            self._active_size += len(record)
+        self._active_file.flush()
+        os.fsync(self._active_file.fileno())
+        return offsets
+
+    async def _flush(self):
+        async with self._flush_lock:
+            self._flush_handle = None
+            buffer, self._buffer = self._buffer, []
+            if not buffer:
+                return
+            try:
+                offsets = await asyncio.get_event_loop().run_in_executor(
+                    None, self._write, [entry[0] for entry in buffer])
+            except Exception as ex:
+                logging.error('Error writing to the spool: {0}'.format(str(ex)))
+                for record, future, _, _ in buffer:
+                    self.size -= len(record)
+                    future.set_result(False)
+                return
+            for (record, future, timestamp, attempts), key in zip(buffer, offsets):
+                self._records[key] = [len(record), timestamp, attempts]
+                self._segments[key[0]][0] += 1
+                future.set_result(True)
+            if self._active_size >= self.segment_size:
+                self._open_segment(self._active + 1)
+            self._update_metrics()
+
+    def _read_record(self, key):
+        segment, offset = key
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return f.read(self._records[key][0])
+
+    def _read(self, key):
+        payload = self._read_record(key)[self.header.size:]
+        return json.loads(payload.decode('utf-8'))['data']
+
+    def _ack(self, key):
+        record = self._records.pop(key, None)
+        if record is None:
+            return
+        self.size -= record[0]
+        segment, offset = key
+        ack_file = self._ack_files.get(segment)
+        if ack_file is None:
+            ack_file = self._ack_files[segment] = open(self._segment_path(segment, 'ack'), 'ab')
+        # Not fsynced: a lost ack only causes a duplicated (idempotent) replay
+        ack_file.write(self.ack_format.pack(offset))
+        ack_file.flush()
+        self._segments[segment][1] += 1
+        self._delete_segment_if_done(segment)
+
+    async def _compact(self):
+        # Move the pending records of mostly acknowledged segments to the
+        # active one so the old segments can be deleted
+        for segment, (records, acked) in list(self._segments.items()):
+            if segment == self._active or not records or acked / records < self.compaction_ratio:
+                continue
+            keys = [key for key in self._records if key[0] == segment and key not in self._replaying]
+            for key in keys:
+                _, timestamp, attempts = self._records[key]
+                if await self._enqueue(self._read_record(key), timestamp, attempts):
+                    self._ack(key)
+                else:
+                    break
+
+    def _update_metrics(self):
+        metrics.SPOOL_EVENTS.set(len(self._records))
+        metrics.SPOOL_BYTES.set(self.size)
+        oldest = next(iter(self._records.values()), None)
+        metrics.SPOOL_OLDEST_EVENT_AGE.set(time.time() - oldest[1] if oldest else 0)
+
+    async def _replay(self, key, handler, semaphore):
+        try:
+            if await handler(self._read(key)):
+                metrics.SPOOL_REPLAYED.inc('success')
+                self._ack(key)
+                self._failures = 0
+                return True
+            self._failures += 1
+            record = self._records[key]
+            record[2] += 1
+            if record[2] >= self.max_attempts:
+                logging.error('Discarding spooled event after {0} attempts'.format(record[2]))
+                metrics.SPOOL_REPLAYED.inc('discarded')
+                self._ack(key)
+            else:
+                metrics.SPOOL_REPLAYED.inc('failure')
+            return False
+        except Exception as ex:
+            logging.error('Error replaying spooled event: {0}'.format(str(ex)))
+            self._failures += 1
+            return False
+        finally:
+            self._replaying.discard(key)
+            semaphore.release()
+
+    async def drain(self, handler, is_available):
+        '''Replays the spooled events with 'handler' while 'is_available()'
+        reports that the Kubernetes API is reachable, backing off otherwise'''
+        semaphore = asyncio.Semaphore(self.drain_concurrency)
+        backoff = 1
+
+        while True:
+            self._update_metrics()
+            if not self._records:
+                await asyncio.sleep(1)
+                continue
+            if not await is_available():
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            logging.info('Draining {0} spooled events'.format(len(self._records)))
+            self._failures = 0
+            tasks = []
+            for key in list(self._records):
+                if key in self._replaying:
+                    continue
+                await semaphore.acquire()
+                if key not in self._records:
+                    semaphore.release()
+                    continue
+                self._replaying.add(key)
+                tasks.append(asyncio.ensure_future(self._replay(key, handler, semaphore)))
+                # Events that fail on their own do not block the rest, but the
+                # round stops when the API looks unavailable again
+                if self._failures >= self.drain_concurrency:
+                    break
+            results = await asyncio.gather(*tasks)
+            if results and not all(results):
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                backoff = 1
+            await self._compact()
@@ -13,4 +13,4 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-__all__ = ['subscriber', 'nats']
\ No newline at end of file
+__all__ = ['subscriber', 'nats', 'local']
\ No newline at end of file
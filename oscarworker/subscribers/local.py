@@ -0,0 +1,91 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import collections
+import json
+import logging
+import uuid
+import oscarworker.utils as utils
+from oscarworker.dedup import EVENT_ID_KEY
+from oscarworker.event import Event
+from oscarworker.subscribers.subscriber import Message, Subscriber
+
+
+class LocalSubscriber(Subscriber):
+    '''In-memory backend for tests and benchmarks.
+
+    Events are published with publish() or read on connection from the
+    JSON lines file in LOCAL_EVENTS_FILE. Nacked events are redelivered
+    at once, up to 'max_redeliveries' times.'''
+
+    max_redeliveries = 5
+
+    def __init__(self):
+        super().__init__()
+        self.events_file = utils.get_environment_variable('LOCAL_EVENTS_FILE')
+        self._queue = collections.deque()
+        self._available = asyncio.Event()
+        self._sequence = 0
+        # Sequences restart in every run, so they are only unique with it
+        self._run_id = uuid.uuid4().hex[:12]
+        self._redeliveries = collections.Counter()
+        self.acked = []
+        self.nacked = []
+
+    def publish(self, event):
+        '''Queues an event (a dict or the JSON message bytes)'''
+        if isinstance(event, dict):
+            event = json.dumps(event).encode('utf-8')
+        self._sequence += 1
+        self._queue.append((self._sequence, event))
+        self._available.set()
+
+    async def connect(self, loop):
+        if self.events_file:
+            with open(self.events_file, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        self.publish(line)
+            logging.info('Loaded {0} events from {1}'.format(len(self._queue), self.events_file))
+
+    async def fetch(self, max_messages, timeout):
+        if not self._queue:
+            self._available.clear()
+            try:
+                await asyncio.wait_for(self._available.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        messages = []
+        while self._queue and len(messages) < max_messages:
+            sequence, raw = self._queue.popleft()
+            try:
+                data = Event.from_message(raw)
+            except ValueError as ex:
+                logging.error('Discarding malformed event {0}: {1}'.format(sequence, str(ex)))
+                continue
+            data[EVENT_ID_KEY] = 'local:{0}:{1}'.format(self._run_id, sequence)
+            messages.append(Message(data, (sequence, raw)))
+        return messages
+
+    async def ack(self, message):
+        self.acked.append(message.data)
+
+    async def nak(self, message):
+        self.nacked.append(message.data)
+        sequence, raw = message.token
+        self._redeliveries[sequence] += 1
+        if self._redeliveries[sequence] <= self.max_redeliveries:
+            self._queue.appendleft((sequence, raw))
+            self._available.set()
@@ -16,20 +16,31 @@
 import asyncio
 import os
 import logging
-import json
+import time
 from nats.aio.client import Client as NATS
 from stan.aio.client import Client as STAN
+import oscarworker.metrics as metrics
 import oscarworker.utils as utils
-from oscarworker.subscribers.subscriber import Subscriber
+from oscarworker.dedup import EVENT_ID_KEY
+from oscarworker.event import Event
+from oscarworker.subscribers.subscriber import Message, Subscriber
 
 class NatsSubscriber(Subscriber):
 
     cluster_id = 'faas-cluster'
     subject = 'faas-request'
     queue_group = 'faas'
+    # Distinguishes the client ID of each backend, so both can be used at once
+    client_id_suffix = ''
 
     def __init__(self):
+        super().__init__()
         self.client_id = 'faas-worker-{0}'.format(os.uname().nodename)
+        # Processes of a multi-process worker need their own client ID
+        worker_index = utils.get_environment_variable('WORKER_INDEX')
+        if worker_index:
+            self.client_id = '{0}-{1}'.format(self.client_id, worker_index)
+        self.client_id += self.client_id_suffix
 
         self.nats_address = utils.get_environment_variable('NATS_ADDRESS')
         if not self.nats_address:
@@ -39,30 +50,131 @@ class NatsSubscriber(Subscriber):
         if not self.nats_port:
             self.nats_port = '4222'
 
-    async def run(self, loop, handler):
+        # Maximum number of unacknowledged messages delivered by NATS Streaming
+        self.max_inflight = utils.get_environment_variable('NATS_MAX_INFLIGHT')
+        if not self.max_inflight:
+            self.max_inflight = 1024
+
+        # Seconds before an unacknowledged message is redelivered
+        self.ack_wait = utils.get_environment_variable('NATS_ACK_WAIT')
+        if not self.ack_wait:
+            self.ack_wait = 30
+
+        self._nc = None
+        self._sc = None
+        # Messages received by the subscription, waiting to be fetched
+        self._buffer = asyncio.Queue()
+
+    async def connect(self, loop, cb=None):
         # Use borrowed connection for NATS then mount NATS Streaming
         # client on top.
         logging.info('Connecting to nats://{0}:{1}...'.format(self.nats_address, self.nats_port))
-        nc = NATS()
-        await nc.connect('{0}:{1}'.format(self.nats_address, self.nats_port), loop=loop)
+        self._nc = NATS()
+        await self._nc.connect('{0}:{1}'.format(self.nats_address, self.nats_port), loop=loop)
 
         # Start session with NATS Streaming cluster.
         logging.info('Establishing connection to cluster: {0} with clientID: {1}...'.format(self.cluster_id, self.client_id))
-        sc = STAN()
-        await sc.connect(self.cluster_id, self.client_id, nats=nc)
+        self._sc = STAN()
+        await self._sc.connect(self.cluster_id, self.client_id, nats=self._nc)
+
+        # Received messages are buffered unless a callback is given. NATS
+        # Streaming stops delivering them after 'max_inflight' unacked ones
+        async def buffer_cb(msg):
+            data = await self._decode(msg)
+            if data is not None:
+                self._buffer.put_nowait(Message(data, msg))
+
+        await self._sc.subscribe(self.subject, queue=self.queue_group, cb=cb or buffer_cb,
+                                 manual_acks=True,
+                                 max_inflight=int(self.max_inflight),
+                                 ack_wait=int(self.ack_wait))
+        logging.info('Listening on "{0}", queue "{1}"'.format(self.subject, self.queue_group))
+
+    async def _decode(self, msg):
+        # Returns the event of the message (None if it is malformed)
+        start = time.time()
+        try:
+            data = Event.from_message(msg.data)
+        except ValueError as ex:
+            logging.error('Discarding malformed event {0}: {1}'.format(msg.seq, str(ex)))
+            await self._sc.ack(msg)
+            return None
+        data.published_at = msg.timestamp / 1e9
+        # Redeliveries keep the sequence and publish time of the message
+        data[EVENT_ID_KEY] = 'stan:{0}:{1}:{2}'.format(self.subject, msg.seq, msg.timestamp)
+        function_name = data.get('Function', '')
+        # Time in the queue since the message was published (in nanoseconds)
+        metrics.STAGE_DURATION.observe(max(start - msg.timestamp / 1e9, 0), function_name, 'receive')
+        metrics.STAGE_DURATION.observe(time.time() - start, function_name, 'json_decode')
+        return data
+
+    async def fetch(self, max_messages, timeout):
+        try:
+            messages = [await asyncio.wait_for(self._buffer.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(messages) < max_messages and not self._buffer.empty():
+            messages.append(self._buffer.get_nowait())
+        return messages
+
+    async def ack(self, message):
+        await self._sc.ack(message.token)
+
+    async def nak(self, message):
+        # NATS Streaming has no negative acknowledgements, the message is
+        # redelivered after 'ack_wait' seconds
+        logging.warning('Event {0} not processed, waiting for redelivery'.format(message.token.seq))
+
+    async def close(self):
+        if self._sc is not None:
+            await self._sc.close()
+        if self._nc is not None:
+            await self._nc.close()
+
+    async def run(self, loop, handler, batch_handler=None):
+        semaphore = asyncio.Semaphore(int(self.max_concurrency))
+
+        # Messages are only acked once the handler succeeds, otherwise they
+        # are redelivered by NATS Streaming after 'ack_wait' seconds
+        async def process(msg, data):
+            metrics.EVENTS_IN_FLIGHT.inc()
+            result = 'error'
+            try:
+                if await handler(data):
+                    result = 'success'
+                    await self._sc.ack(msg)
+                else:
+                    result = 'failure'
+                    logging.warning('Event {0} not processed, waiting for redelivery'.format(msg.seq))
+            except Exception as ex:
+                logging.error('Error processing event {0}: {1}'.format(msg.seq, str(ex)))
+            finally:
+                semaphore.release()
+                metrics.EVENTS_IN_FLIGHT.dec()
+                metrics.EVENTS_PROCESSED.inc(data.get('Function', ''), result)
 
         # Send msg.data to handler (KubernetesClient.launch_job())
+        # STAN awaits the callback before delivering the next message, so
+        # waiting for a free slot here stops pulling messages when the worker
+        # is saturated. Handlers run as tasks to process events concurrently
         async def cb(msg):
-            data = json.loads(msg.data.decode('utf-8'))
-            handler(data)
+            metrics.EVENTS_RECEIVED.inc()
+            data = await self._decode(msg)
+            if data is None:
+                return
+            await semaphore.acquire()
+            asyncio.ensure_future(process(msg, data))
 
         try:
-            await sc.subscribe(self.subject, queue=self.queue_group, cb=cb)
-            logging.info('Listening on "{0}", queue "{1}"'.format(self.subject, self.queue_group))
+            await self.connect(loop, cb)
         except asyncio.CancelledError as e:
-            await sc.close()
-            await nc.close()
+            await self.close()
             raise e
 
 
+class NatsPullSubscriber(NatsSubscriber):
+    '''NATS Streaming backend fetching the buffered messages in batches'''
+
+    client_id_suffix = '-pull'
 
+    run = Subscriber.run
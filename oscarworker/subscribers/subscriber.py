@@ -12,11 +12,124 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-
 import abc
+import asyncio
+import logging
+import oscarworker.metrics as metrics
+import oscarworker.utils as utils
+
+
+class Message:
+    '''Event fetched from a subscriber, with the backend handle used to
+    acknowledge it'''
+
+    def __init__(self, data, token):
+        self.data = data
+        self.token = token
+
 
 class Subscriber(metaclass=abc.ABCMeta):
+    '''Source of events.
+
+    Backends implement connect(), fetch(), ack() and nak(). Every fetched
+    message must be acknowledged with ack() once processed or with nak() to
+    have it redelivered. Flow control: the backend must not buffer more
+    than its own limit of unacknowledged messages and run() never holds
+    more than 'max_concurrency' fetched messages.'''
+
+    def __init__(self):
+        # Maximum number of events held by the worker (queued or being processed)
+        self.max_concurrency = utils.get_environment_variable('WORKER_MAX_CONCURRENCY')
+        if not self.max_concurrency:
+            self.max_concurrency = 512
+
+        # Maximum number of messages fetched at once
+        self.batch_size = utils.get_environment_variable('SUBSCRIBER_BATCH_SIZE')
+        if not self.batch_size:
+            self.batch_size = 64
+
+        # Seconds waiting for the first message of a batch
+        self.fetch_timeout = utils.get_environment_variable('SUBSCRIBER_FETCH_TIMEOUT')
+        if not self.fetch_timeout:
+            self.fetch_timeout = 1
+
+    @abc.abstractmethod
+    async def connect(self, loop):
+        pass
 
     @abc.abstractmethod
-    def run(self, loop, handler):
+    async def fetch(self, max_messages, timeout):
+        '''Returns up to 'max_messages' messages, waiting at most 'timeout'
+        seconds for the first one (an empty list if none arrived)'''
         pass
+
+    @abc.abstractmethod
+    async def ack(self, message):
+        pass
+
+    @abc.abstractmethod
+    async def nak(self, message):
+        pass
+
+    async def close(self):
+        pass
+
+    async def _process(self, messages, handler, batch_handler):
+        if batch_handler:
+            try:
+                results = await batch_handler([message.data for message in messages])
+            except Exception as ex:
+                logging.error('Error processing batch of {0} events: {1}'.format(len(messages), str(ex)))
+                results = [ex] * len(messages)
+        else:
+            results = await asyncio.gather(*[handler(message.data) for message in messages],
+                                           return_exceptions=True)
+        for message, result in zip(messages, results):
+            if result is True:
+                await self.ack(message)
+                outcome = 'success'
+            else:
+                await self.nak(message)
+                outcome = 'failure' if result is False else 'error'
+                if outcome == 'error':
+                    logging.error('Error processing event: {0}'.format(str(result)))
+            metrics.EVENTS_PROCESSED.inc(message.data.get('Function', ''), outcome)
+        metrics.EVENTS_IN_FLIGHT.dec(len(messages))
+
+    async def run(self, loop, handler, batch_handler=None):
+        '''Connects and keeps pulling messages in background'''
+        await self.connect(loop)
+        return asyncio.ensure_future(self._pull(handler, batch_handler))
+
+    async def _pull(self, handler, batch_handler):
+        # Fetches batches of messages while there is room for them and sends
+        # them to 'batch_handler' (returning a result per event) if given or
+        # to 'handler' one by one
+        max_concurrency = int(self.max_concurrency)
+        held = 0
+        freed = asyncio.Event()
+
+        async def process(messages):
+            nonlocal held
+            try:
+                await self._process(messages, handler, batch_handler)
+            finally:
+                held -= len(messages)
+                freed.set()
+
+        try:
+            while True:
+                while held >= max_concurrency:
+                    freed.clear()
+                    await freed.wait()
+                messages = await self.fetch(min(int(self.batch_size), max_concurrency - held),
+                                            float(self.fetch_timeout))
+                if not messages:
+                    continue
+                held += len(messages)
+                metrics.EVENTS_RECEIVED.inc(amount=len(messages))
+                metrics.EVENTS_IN_FLIGHT.inc(amount=len(messages))
+                asyncio.ensure_future(process(messages))
+        except asyncio.CancelledError:
+            await self.close()
+            raise
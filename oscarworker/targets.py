@@ -0,0 +1,348 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import logging
+import random
+import re
+import ssl
+import time
+import aiohttp
+from packaging import version
+import oscarworker.metrics as metrics
+import oscarworker.utils as utils
+from oscarworker.jobgc import is_job_finished
+from oscarworker.ratelimit import AdaptiveRateLimiter
+from oscarworker.watcher import ResourceWatcher
+
+LEAST_LOADED = 'least-loaded'
+WEIGHTED = 'weighted'
+
+
+class KubernetesTarget:
+    '''Kubernetes API server and namespace where Jobs are created, with its
+    own credentials, connection pool and rate limiter.
+
+    It also keeps the live signals used to route Jobs to it: the active
+    Jobs and pending pods of its namespace (when they are watched), the
+    Jobs being posted and the smoothed latency and error rate of the posts.'''
+
+    # Requests are retried when throttled, failed or unreachable (None)
+    retriable_statuses = (None, 429, 500, 502, 503, 504)
+    # Statuses of failed Job posts that are tried in other targets: the
+    # retriable ones and those caused by the target itself (credentials or
+    # missing namespace)
+    failover_statuses = retriable_statuses + (401, 403, 404)
+    base_backoff = 0.2
+    max_backoff = 10
+    version_path = '/version'
+    # Seconds to wait for the health probes
+    probe_timeout = 5
+    smoothing = 0.2
+
+    def __init__(self, name, host, port, token, scheme='https', ca_file=None, namespace='oscar-fn', pool_size=20,
+                 qps=200, burst=200, max_qps=2000, max_retries=5, weight=1.0, connect_timeout=10, read_timeout=30):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.token = token
+        self.scheme = scheme
+        # CA certificate to verify the server (not verified if not set)
+        self.ca_file = ca_file
+        self.namespace = namespace
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.weight = weight
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.create_job_path = '/apis/batch/v1/namespaces/{0}/jobs'.format(namespace)
+        self.create_config_map_path = '/api/v1/namespaces/{0}/configmaps'.format(namespace)
+        self.pods_path = '/api/v1/namespaces/{0}/pods'.format(namespace)
+        self.rate_limiter = AdaptiveRateLimiter(float(qps), float(burst), max_rate=float(max_qps))
+        self.kubernetes_version = None
+        self._session = None
+        # Load and health
+        self.active_jobs = set()
+        self.pending_pods = set()
+        self.posting = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.healthy = True
+
+    def _gen_auth_header(self):
+        return {'Authorization': 'Bearer ' + self.token}
+
+    def _build_url(self, path):
+        return '{0}://{1}:{2}{3}'.format(self.scheme, self.host, self.port, path)
+
+    def _get_session(self):
+        # The session must be created inside the running event loop, so it is
+        # built on first use and then shared by all requests
+        if self._session is None or self._session.closed:
+            if self.ca_file:
+                ssl_context = ssl.create_default_context(cafile=self.ca_file)
+            elif self.ca_file is None:
+                # Verified with the system CAs
+                ssl_context = ssl.create_default_context()
+            else:
+                ssl_context = False
+            connector = aiohttp.TCPConnector(limit=int(self.pool_size), ssl=ssl_context)
+            timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self._gen_auth_header(),
+                                                  timeout=timeout)
+        return self._session
+
+    def _get_retry_after(self, headers):
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    async def _send_request(self, method, url, headers, json, data, function_name, timeout=None):
+        # Single attempt, returns the status (None if the server could not
+        # be reached or timed out), the response body and the Retry-After delay
+        await self.rate_limiter.acquire()
+        start = time.perf_counter()
+        metrics.KUBERNETES_REQUESTS_IN_FLIGHT.inc()
+        code = 'error'
+        try:
+            session = self._get_session()
+            kwargs = {'timeout': timeout} if timeout is not None else {}
+            async with session.request(method, url, headers=headers, json=json, data=data, **kwargs) as resp:
+                code = str(resp.status)
+                if resp.status in [200, 201, 202]:
+                    return resp.status, await resp.json(), None
+                if resp.status == 429 and 'X-Kubernetes-PF-PriorityLevel-UID' in resp.headers:
+                    logging.warning('Request rejected by API Priority and Fairness (priority level {0})'.format(
+                        resp.headers['X-Kubernetes-PF-PriorityLevel-UID']))
+                return resp.status, await resp.text(), self._get_retry_after(resp.headers)
+        except Exception as ex:
+            return None, str(ex), None
+        finally:
+            metrics.KUBERNETES_REQUESTS_IN_FLIGHT.dec()
+            metrics.KUBERNETES_REQUESTS.inc(function_name, method, code)
+            metrics.KUBERNETES_REQUEST_DURATION.observe(time.perf_counter() - start, method)
+
+    async def _request(self, method, url, headers=None, json=None, data=None, function_name=''):
+        '''Returns the status and the decoded body (None on errors) of the
+        request, retrying throttled, failed and unreachable requests with
+        jittered exponential backoff'''
+        if data is not None:
+            # Already serialized JSON body
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        attempt = 0
+        while True:
+            status, body, retry_after = await self._send_request(method, url, headers, json, data, function_name)
+            if status in [200, 201, 202]:
+                self.rate_limiter.on_success()
+                metrics.KUBERNETES_RATE_LIMIT.set(self.rate_limiter.rate)
+                return status, body
+            if status == 429 or (status == 503 and retry_after):
+                self.rate_limiter.on_throttle()
+                metrics.KUBERNETES_RATE_LIMIT.set(self.rate_limiter.rate)
+            if status not in self.retriable_statuses or attempt >= int(self.max_retries):
+                break
+            # The request is not retried before the Retry-After delay
+            delay = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+            attempt += 1
+            metrics.KUBERNETES_RETRIES.inc(method)
+            await asyncio.sleep(max(delay, retry_after or 0))
+        if status != 409:
+            logging.error('Error contacting Kubernetes API {0}: {1} - {2}'.format(self.name, status, body))
+        return status, None
+
+    async def _create_request(self, method, url, headers=None, json=None, data=None, function_name=''):
+        _, body = await self._request(method, url, headers, json, data, function_name)
+        return body
+
+    async def _watch_request(self, url, callback):
+        # Reads a WATCH stream calling 'callback' with each JSON line until the
+        # server closes it or the callback returns False
+        session = self._get_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=ResourceWatcher.watch_timeout_seconds + 30)
+        async with session.get(url, timeout=timeout) as resp:
+            if resp.status != 200:
+                raise Exception('{0} - {1}'.format(resp.status, await resp.text()))
+            buffer = b''
+            async for chunk in resp.content.iter_any():
+                buffer += chunk
+                while b'\n' in buffer:
+                    line, buffer = buffer.split(b'\n', 1)
+                    if line.strip() and callback(line) is False:
+                        return
+
+    async def get_version(self):
+        if self.kubernetes_version is None:
+            version_info = await self._create_request('GET', self._build_url(self.version_path))
+            if not version_info:
+                logging.error('Error getting Kubernetes version of {0}'.format(self.name))
+                return None
+            # Drop distribution suffixes (e.g. 'v1.25.3-gke.100')
+            git_version = re.match(r'v?(\d+\.\d+(\.\d+)?)', version_info['gitVersion'])
+            self.kubernetes_version = version.parse(git_version.group(1))
+        return self.kubernetes_version
+
+    async def is_available(self):
+        # Single request, without retries and with a short timeout
+        status, _, _ = await self._send_request('GET', self._build_url(self.version_path), None, None, None, '',
+                                                timeout=aiohttp.ClientTimeout(total=self.probe_timeout))
+        return status == 200
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def get_score(self):
+        '''Load of the target relative to its weight, higher when its posts
+        are slow or failing'''
+        load = len(self.active_jobs) + 2 * len(self.pending_pods) + self.posting + 1
+        return load / self.weight * (1 + self.latency / 0.1) * (1 + 4 * self.error_rate)
+
+    def record_post(self, success, latency=None):
+        self.error_rate += self.smoothing * ((0.0 if success else 1.0) - self.error_rate)
+        if success:
+            self.latency += self.smoothing * (latency - self.latency)
+            self.failures = 0
+        else:
+            self.failures += 1
+
+    def set_healthy(self, healthy):
+        if healthy != self.healthy:
+            if healthy:
+                logging.info('Kubernetes target {0} is available again'.format(self.name))
+            else:
+                logging.warning('Kubernetes target {0} is unavailable, failing over'.format(self.name))
+        self.healthy = healthy
+        self.failures = 0
+        metrics.TARGET_HEALTHY.set(1 if healthy else 0, self.name)
+
+    def _update_job(self, event_type, job):
+        name = job['metadata']['name']
+        if event_type == 'DELETED' or is_job_finished(job):
+            self.active_jobs.discard(name)
+        else:
+            self.active_jobs.add(name)
+
+    def resync_jobs(self, jobs):
+        self.active_jobs = set()
+        for job in jobs:
+            self._update_job('ADDED', job)
+        metrics.TARGET_ACTIVE_JOBS.set(len(self.active_jobs), self.name)
+
+    def update_job(self, event_type, job):
+        self._update_job(event_type, job)
+        metrics.TARGET_ACTIVE_JOBS.set(len(self.active_jobs), self.name)
+
+    def _update_pod(self, event_type, pod):
+        name = pod['metadata']['name']
+        if event_type != 'DELETED' and pod.get('status', {}).get('phase', 'Pending') == 'Pending':
+            self.pending_pods.add(name)
+        else:
+            self.pending_pods.discard(name)
+
+    def resync_pods(self, pods):
+        self.pending_pods = set()
+        for pod in pods:
+            self._update_pod('ADDED', pod)
+        metrics.TARGET_PENDING_PODS.set(len(self.pending_pods), self.name)
+
+    def update_pod(self, event_type, pod):
+        self._update_pod(event_type, pod)
+        metrics.TARGET_PENDING_PODS.set(len(self.pending_pods), self.name)
+
+
+class TargetRouter:
+    '''Chooses the target of each Job.
+
+    The 'least-loaded' policy picks the healthy target with the lowest
+    score (see KubernetesTarget.get_score), 'weighted' spreads the Jobs
+    randomly in proportion to the target weights. A target is considered
+    unhealthy after 'failure_threshold' consecutive failed posts, and is
+    probed every 'health_interval' seconds until it is available again.'''
+
+    def __init__(self, targets, policy=LEAST_LOADED, failure_threshold=3, health_interval=5):
+        self.targets = targets
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.health_interval = health_interval
+        for target in targets:
+            metrics.TARGET_HEALTHY.set(1, target.name)
+
+    def choose(self, exclude=()):
+        '''Returns the target for the next Job, skipping the 'exclude'd ones
+        (None when there are no more targets)'''
+        candidates = [target for target in self.targets if target not in exclude]
+        # Unhealthy targets are only tried when every target is unhealthy
+        candidates = [target for target in candidates if target.healthy] or candidates
+        if not candidates:
+            return None
+        if self.policy == WEIGHTED:
+            # Same as random.choices, which needs Python 3.6
+            point = random.uniform(0, sum(target.weight for target in candidates))
+            for target in candidates:
+                point -= target.weight
+                if point <= 0:
+                    return target
+            return candidates[-1]
+        return min(candidates, key=lambda target: (target.get_score(), random.random()))
+
+    def record_post(self, target, success, latency=None):
+        target.record_post(success, latency)
+        if success:
+            metrics.JOBS_ROUTED.inc(target.name)
+        elif target.healthy and target.failures >= self.failure_threshold:
+            target.set_healthy(False)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for target in self.targets:
+                if not target.healthy and await target.is_available():
+                    target.set_healthy(True)
+
+
+def load_targets(config, defaults):
+    '''Builds the targets from their JSON configuration (a list of objects),
+    taking the missing settings from 'defaults' '''
+    targets = []
+    for index, settings in enumerate(json.loads(config)):
+        name = settings.get('name') or 'target-{0}'.format(index)
+        inherited = dict(defaults)
+        if settings.get('host', defaults['host']) != defaults['host']:
+            # The credentials of the local cluster are not sent to other API servers
+            inherited.pop('token', None)
+            inherited['ca_file'] = None
+        settings = dict(inherited, **settings)
+        # Tokens are usually mounted from a secret
+        if settings.get('token_file'):
+            settings['token'] = utils.read_file(settings['token_file']).strip()
+        if not settings.get('token'):
+            raise ValueError('Target {0} has no token or token_file'.format(name))
+        targets.append(KubernetesTarget(name,
+                                        settings['host'], settings['port'], settings['token'],
+                                        scheme=settings['scheme'],
+                                        ca_file=settings.get('ca_file'),
+                                        namespace=settings['namespace'],
+                                        pool_size=int(settings['pool_size']),
+                                        qps=float(settings['qps']),
+                                        burst=float(settings['burst']),
+                                        max_qps=float(settings['max_qps']),
+                                        max_retries=int(settings['max_retries']),
+                                        connect_timeout=float(settings['connect_timeout']),
+                                        read_timeout=float(settings['read_timeout']),
+                                        weight=float(settings.get('weight', 1.0))))
+    return targets
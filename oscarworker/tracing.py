@@ -0,0 +1,278 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import asyncio
+import collections
+import json
+import logging
+import os
+import aiohttp
+import oscarworker.metrics as metrics
+import oscarworker.utils as utils
+from oscarworker.jobtemplate import FUNCTION_LABEL, TRACE_ID_ANNOTATION, RECEIVED_ANNOTATION, POSTED_ANNOTATION
+
+Span = collections.namedtuple('Span', ['trace_id', 'span_id', 'parent_id', 'name', 'start', 'end', 'attributes'])
+
+
+def get_root_span_id(trace_id):
+    # Known by every process, so their spans share the same parent
+    return trace_id[:16]
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+class Trace:
+    '''Invocation of a function, from the reception of its event'''
+
+    def __init__(self, function_name, received_at, published_at=None):
+        self.trace_id = os.urandom(16).hex()
+        self.function_name = function_name
+        self.received_at = received_at
+        self.published_at = published_at
+
+    def get_annotations(self, posted_at):
+        '''Slot values of the Job annotations'''
+        return {
+            'trace_id': self.trace_id,
+            'received_at': '{0:.6f}'.format(self.received_at),
+            'posted_at': '{0:.6f}'.format(posted_at)
+        }
+
+
+def get_pod_stages(pod, annotations):
+    '''Returns the (stage, start, end) of the transitions of a Job pod so far
+    and whether it has finished'''
+    times = {
+        'received': float(annotations[RECEIVED_ANNOTATION]),
+        'posted': float(annotations[POSTED_ANNOTATION]),
+        'created': utils.parse_time(pod['metadata']['creationTimestamp'])
+    }
+    status = pod.get('status', {})
+    for condition in status.get('conditions') or []:
+        if condition['status'] == 'True' and condition.get('lastTransitionTime'):
+            if condition['type'] == 'PodScheduled':
+                times['scheduled'] = utils.parse_time(condition['lastTransitionTime'])
+            elif condition['type'] == 'Initialized':
+                times['initialized'] = utils.parse_time(condition['lastTransitionTime'])
+    finished = False
+    for container_status in status.get('containerStatuses') or []:
+        state = container_status.get('state', {})
+        current = state.get('running') or state.get('terminated') or {}
+        if current.get('startedAt'):
+            times['started'] = utils.parse_time(current['startedAt'])
+        if status.get('phase') in ('Succeeded', 'Failed') and 'terminated' in state:
+            times['finished'] = utils.parse_time(state['terminated']['finishedAt'])
+            finished = True
+        break
+    stages = []
+    for stage, start, end in (('job_controller', 'posted', 'created'),
+                              ('scheduling', 'created', 'scheduled'),
+                              ('initialization', 'scheduled', 'initialized'),
+                              ('container_start', 'initialized', 'started'),
+                              ('execution', 'started', 'finished'),
+                              ('invocation', 'received', 'finished')):
+        if start in times and end in times:
+            # Kubernetes timestamps are truncated to seconds
+            stages.append((stage, times[start], max(times[start], times[end])))
+    return stages, finished
+
+
+class SpanExporter(metaclass=abc.ABCMeta):
+    '''Buffers the spans and sends them every 'interval' seconds'''
+
+    max_buffer = 10000
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self._spans = []
+
+    def export(self, span):
+        if len(self._spans) >= self.max_buffer:
+            # Drop the oldest spans while the destination is not available
+            del self._spans[:len(self._spans) // 10]
+        self._spans.append(span)
+
+    async def flush(self):
+        spans, self._spans = self._spans, []
+        if spans:
+            try:
+                await self._send(spans)
+            except Exception as ex:
+                logging.error('Error exporting {0} spans: {1}'.format(len(spans), str(ex)))
+
+    @abc.abstractmethod
+    async def _send(self, spans):
+        pass
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self):
+        await self.flush()
+
+
+class FileExporter(SpanExporter):
+    '''Appends the spans to a file as JSON lines'''
+
+    def __init__(self, path, interval=5):
+        super().__init__(interval)
+        self.path = path
+
+    def _write(self, lines):
+        with open(self.path, 'a') as f:
+            f.write(lines)
+
+    async def _send(self, spans):
+        lines = ''.join(json.dumps(span._asdict()) + '\n' for span in spans)
+        await asyncio.get_event_loop().run_in_executor(None, self._write, lines)
+
+
+class OtlpExporter(SpanExporter):
+    '''Sends the spans to an OpenTelemetry collector (OTLP/HTTP with JSON)'''
+
+    def __init__(self, endpoint, service_name='oscar-worker', interval=5, timeout=10):
+        super().__init__(interval)
+        self.url = '{0}/v1/traces'.format(endpoint.rstrip('/'))
+        self.service_name = service_name
+        self.timeout = timeout
+        self._session = None
+
+    @staticmethod
+    def _encode_attributes(attributes):
+        return [{'key': key, 'value': {'stringValue': str(value)}} for key, value in attributes.items()]
+
+    def _encode(self, spans):
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': self._encode_attributes({'service.name': self.service_name})},
+                'scopeSpans': [{
+                    'scope': {'name': 'oscarworker'},
+                    'spans': [{
+                        'traceId': span.trace_id,
+                        'spanId': span.span_id,
+                        'parentSpanId': span.parent_id or '',
+                        'name': span.name,
+                        # SPAN_KIND_INTERNAL
+                        'kind': 1,
+                        'startTimeUnixNano': str(int(span.start * 1e9)),
+                        'endTimeUnixNano': str(int(span.end * 1e9)),
+                        'attributes': self._encode_attributes(span.attributes)
+                    } for span in spans]
+                }]
+            }]
+        }
+
+    async def _send(self, spans):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.post(self.url, json=self._encode(spans)) as resp:
+            if resp.status >= 300:
+                raise Exception('{0} - {1}'.format(resp.status, await resp.text()))
+
+    async def close(self):
+        await super().close()
+        if self._session is not None:
+            await self._session.close()
+
+
+class Tracer:
+    '''Records the latency of each stage of the invocations.
+
+    The worker stamps the Jobs with a trace ID and the time their event was
+    received and their definition was posted, and emits the spans of its
+    own stages. When 'watch_pods' is set (only one process needs to), the
+    Job pods are followed to emit the spans of the Kubernetes stages: Job
+    controller, scheduling, initialization, container start (image pull
+    included) and execution, plus the whole invocation as their parent.
+    Every span is aggregated by function and stage in a histogram and sent
+    to the 'exporter', if any.'''
+
+    # Finished pods remembered to skip them when they are listed again
+    max_finished = 10000
+
+    def __init__(self, exporter=None, watch_pods=True):
+        self.exporter = exporter
+        self.watch_pods = watch_pods
+        # uid -> stages already emitted
+        self._pods = {}
+        self._finished = collections.OrderedDict()
+
+    def start_trace(self, data):
+        return Trace(data.function_name, data.received_at, data.published_at)
+
+    def _emit(self, trace_id, name, start, end, function_name, parent_id=None, **attributes):
+        metrics.INVOCATION_STAGE_DURATION.observe(end - start, function_name, name)
+        if self.exporter is not None:
+            if parent_id is None:
+                parent_id = get_root_span_id(trace_id)
+            attributes['function'] = function_name
+            span_id = get_root_span_id(trace_id) if name == 'invocation' else new_span_id()
+            self.exporter.export(Span(trace_id, span_id, parent_id or None, name, start, end, attributes))
+
+    def record_submission(self, trace, job_name, posted_at, created_at):
+        '''Emits the spans of the worker stages of a Job created at 'created_at' '''
+        if trace.published_at is not None:
+            self._emit(trace.trace_id, 'queue', trace.published_at, max(trace.published_at, trace.received_at),
+                       trace.function_name, job=job_name)
+        self._emit(trace.trace_id, 'worker', trace.received_at, posted_at, trace.function_name, job=job_name)
+        self._emit(trace.trace_id, 'job_post', posted_at, created_at, trace.function_name, job=job_name)
+
+    def _update_pod(self, event_type, pod, emit=True):
+        metadata = pod['metadata']
+        annotations = metadata.get('annotations') or {}
+        trace_id = annotations.get(TRACE_ID_ANNOTATION)
+        uid = metadata['uid']
+        if not trace_id or uid in self._finished:
+            return
+        emitted = self._pods.setdefault(uid, set())
+        labels = metadata.get('labels') or {}
+        try:
+            stages, finished = get_pod_stages(pod, annotations)
+        except (KeyError, ValueError) as ex:
+            logging.warning('Invalid trace of pod {0}: {1}'.format(metadata['name'], str(ex)))
+            stages, finished = [], True
+        for stage, start, end in stages:
+            if stage not in emitted:
+                emitted.add(stage)
+                if emit:
+                    self._emit(trace_id, stage, start, end, labels.get(FUNCTION_LABEL, ''),
+                               parent_id='' if stage == 'invocation' else None,
+                               job=labels.get('job-name', ''), pod=metadata['name'])
+        if finished or event_type == 'DELETED':
+            del self._pods[uid]
+            if finished:
+                self._finished[uid] = True
+                while len(self._finished) > self.max_finished:
+                    self._finished.popitem(last=False)
+
+    def resync(self, pods):
+        # Transitions that happened before the list are not emitted again
+        for pod in pods:
+            self._update_pod('ADDED', pod, emit=False)
+
+    def update(self, event_type, pod):
+        self._update_pod(event_type, pod)
+
+    async def run(self):
+        if self.exporter is not None:
+            await self.exporter.run()
+
+    async def close(self):
+        if self.exporter is not None:
+            await self.exporter.close()
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import base64
+import datetime
 import json
 import os
 import re
@@ -165,6 +166,26 @@ def get_environment_variable(variable):
     if is_variable_in_environment(variable):
         return os.environ[variable]
 
+QUANTITY_SUFFIXES = {
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+    'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18
+}
+
+def parse_quantity(value):
+    '''Converts a Kubernetes resource quantity (e.g. '250m', '256Mi') to a float'''
+    value = str(value)
+    for suffix in ('Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei'):
+        if value.endswith(suffix):
+            return float(value[:-2]) * QUANTITY_SUFFIXES[suffix]
+    if value and value[-1] in QUANTITY_SUFFIXES:
+        return float(value[:-1]) * QUANTITY_SUFFIXES[value[-1]]
+    return float(value)
+
+def parse_time(value):
+    '''Converts a Kubernetes timestamp (e.g. '2021-01-01T00:00:00Z') to seconds since the epoch'''
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+
 def parse_arg_list(arg_keys, cmd_args):
     result = {}
     for key in arg_keys:
@@ -0,0 +1,366 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import base64
+import logging
+import math
+import time
+import uuid
+import aiohttp
+import oscarworker.metrics as metrics
+from oscarworker.jobtemplate import get_deployment_setting
+
+# Deployment annotation (or label) with the maximum executors of a function
+WARM_POOL_ANNOTATION = 'oscar.grycap/warm-pool-max'
+
+POOL_LABEL = 'oscar-worker/pool'
+OWNER_LABEL = 'oscar-worker/pool-owner'
+# Worker pod of the owner process, to find the executors left by deleted pods
+OWNER_POD_LABEL = 'oscar-worker/pool-owner-pod'
+VERSION_LABEL = 'oscar-worker/pool-version'
+
+# Port of the OpenFaaS watchdog of the function images
+EXECUTOR_PORT = 8080
+
+
+def get_owner(pod_name, worker_index):
+    '''Owner label of the executors of a worker process'''
+    return '{0}-{1}'.format(pod_name[:50], worker_index)
+
+def build_executor_pod(deployment_info, namespace, name, owner, owner_pod=None):
+    '''Long-lived pod running the function container (and its watchdog)'''
+    metadata = deployment_info['metadata']
+    pod_spec = deployment_info['spec']['template']['spec']
+    container_info = pod_spec['containers'][0]
+    container = {
+        'name': container_info['name'],
+        'image': container_info['image'],
+        'env': container_info.get('env', []),
+        'ports': [{'containerPort': EXECUTOR_PORT}],
+        'readinessProbe': {'tcpSocket': {'port': EXECUTOR_PORT}, 'periodSeconds': 2},
+        'volumeMounts': container_info.get('volumeMounts', [])
+    }
+    if container_info.get('resources'):
+        container['resources'] = container_info['resources']
+    labels = {
+        POOL_LABEL: metadata['name'],
+        OWNER_LABEL: owner,
+        VERSION_LABEL: str(metadata.get('generation', ''))
+    }
+    if owner_pod:
+        labels[OWNER_POD_LABEL] = owner_pod
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'metadata': {
+            'name': name,
+            'namespace': namespace,
+            'labels': labels
+        },
+        'spec': {
+            'containers': [container],
+            'volumes': pod_spec.get('volumes', []),
+            'restartPolicy': 'Always'
+        }
+    }
+
+def is_pod_ready(pod):
+    for condition in pod.get('status', {}).get('conditions') or []:
+        if condition['type'] == 'Ready':
+            return condition['status'] == 'True'
+    return False
+
+
+class Executor:
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.ip = None
+        self.ready = False
+        self.busy = False
+
+
+class Pool:
+    '''Executors of a function and its observed load'''
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.deployment_info = None
+        self.max_size = 0
+        self.executors = {}
+        # EWMA of the arrival rate (events/s) and execution time (s)
+        self.rate = 0.0
+        self.service_time = 1.0
+        self.arrivals = 0
+        self.last_event = time.time()
+
+    @property
+    def version(self):
+        # Only changes with the deployment spec (unlike its resourceVersion)
+        if self.deployment_info is None:
+            return None
+        return str(self.deployment_info['metadata'].get('generation', ''))
+
+
+class WarmPool:
+    '''Keeps warm executor pods for the functions that enable it and sends
+    them their events over HTTP, bypassing the Job and pod startup.
+
+    Each executor runs one event at a time. When no executor is idle the
+    event follows the Job path, as do the events whose execution fails.
+    Pools are resized every 'interval' seconds to the executors needed for
+    the observed load (arrival rate times execution time) and emptied after
+    'idle_timeout' seconds without events.
+
+    Executors are labelled with their owner process and its worker pod
+    ('owner_pod'). When 'owner_pod_namespace' is set, the executors whose
+    worker pod no longer exists (e.g. replaced after a crash) and those of
+    the processes of this pod beyond 'worker_count' are deleted every
+    'orphan_interval' seconds.'''
+
+    headroom = 1.2
+    smoothing = 0.3
+    # Request headers not forwarded to the executors
+    hop_headers = ('Host', 'Content-Length', 'Connection', 'Transfer-Encoding')
+
+    def __init__(self, kube_client, namespace, owner, fallback, idle_timeout=300, request_timeout=300,
+                 interval=5, owner_pod=None, owner_pod_namespace=None, worker_count=1, orphan_interval=60):
+        self.kube_client = kube_client
+        self.namespace = namespace
+        self.pods_path = '/api/v1/namespaces/{0}/pods'.format(namespace)
+        self.owner = owner
+        self.owner_pod = owner_pod
+        self.owner_pod_namespace = owner_pod_namespace
+        self.worker_count = worker_count
+        self.orphan_interval = orphan_interval
+        # Called with the events that an executor failed to receive or run
+        self.fallback = fallback
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.interval = interval
+        self._pools = {}
+        self._session = None
+        self._last_reconcile = time.time()
+        self._last_orphan_check = 0
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+            self._session = aiohttp.ClientSession(timeout=timeout)
+        return self._session
+
+    def _get_pool(self, function_name):
+        pool = self._pools.get(function_name)
+        if pool is None:
+            pool = self._pools[function_name] = Pool(function_name)
+        return pool
+
+    def dispatch(self, deployment_info, data):
+        '''Sends the event to an idle executor, returns False if the function
+        has no warm pool or all its executors are busy'''
+        try:
+            max_size = int(get_deployment_setting(deployment_info, WARM_POOL_ANNOTATION, 0))
+        except ValueError:
+            max_size = 0
+        if max_size <= 0:
+            return False
+        function_name = data['Function']
+        pool = self._get_pool(function_name)
+        pool.deployment_info = deployment_info
+        pool.max_size = max_size
+        pool.arrivals += 1
+        pool.last_event = time.time()
+        for executor in pool.executors.values():
+            if executor.ready and not executor.busy and executor.version == pool.version:
+                executor.busy = True
+                asyncio.ensure_future(self._invoke(pool, executor, data))
+                return True
+        metrics.WARM_POOL_EVENTS.inc(function_name, 'saturated')
+        return False
+
+    def _build_request(self, data):
+        headers = {}
+        for key, value in (data.get('Header') or {}).items():
+            if key not in self.hop_headers:
+                headers[key] = value[0]
+        url = 'http://{0}:{1}/'
+        if data.get('QueryString'):
+            url += '?' + data['QueryString']
+        return url, headers, base64.b64decode(data['Body'])
+
+    async def _invoke(self, pool, executor, data):
+        url, headers, body = self._build_request(data)
+        start = time.perf_counter()
+        try:
+            session = self._get_session()
+            async with session.post(url.format(executor.ip, EXECUTOR_PORT), data=body, headers=headers) as resp:
+                await resp.read()
+                status = resp.status
+            pool.service_time += self.smoothing * (time.perf_counter() - start - pool.service_time)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            # Stop using the executor until the pod reports ready again
+            logging.error('Error sending event to executor {0}: {1}'.format(executor.name, str(ex)))
+            executor.ready = False
+            status = None
+        finally:
+            executor.busy = False
+        if status is not None and status < 400:
+            metrics.WARM_POOL_EVENTS.inc(pool.function_name, 'dispatched')
+            logging.info('Event sent to executor {0}'.format(executor.name))
+            return
+        if status is not None:
+            logging.warning('Function {0} failed in executor {1}: {2}'.format(
+                pool.function_name, executor.name, status))
+        metrics.WARM_POOL_EVENTS.inc(pool.function_name, 'failed')
+        # The event was already acknowledged, so it is retried as a Job
+        # (which also retries failed executions up to its backoff limit)
+        if not await self.fallback(data):
+            logging.error('Event of function {0} lost after failing in executor {1}'.format(
+                pool.function_name, executor.name))
+
+    def _get_desired_size(self, pool, elapsed):
+        pool.rate += self.smoothing * (pool.arrivals / elapsed - pool.rate)
+        pool.arrivals = 0
+        if pool.deployment_info is None or time.time() - pool.last_event > self.idle_timeout:
+            return 0
+        # Little's law: executors busy on average for the observed load
+        size = math.ceil(pool.rate * pool.service_time * self.headroom)
+        return min(pool.max_size, max(1, size))
+
+    async def _create_executor(self, pool):
+        name = '{0}-pool-{1}'.format(pool.function_name, str(uuid.uuid4())[:8])
+        definition = build_executor_pod(pool.deployment_info, self.namespace, name, self.owner, self.owner_pod)
+        pool.executors[name] = Executor(name, pool.version)
+        status, _ = await self.kube_client._request('POST', self.kube_client._build_url(self.pods_path),
+                                                    json=definition, function_name=pool.function_name)
+        if status not in [200, 201, 202]:
+            pool.executors.pop(name, None)
+
+    async def _delete_executor(self, pool, executor):
+        pool.executors.pop(executor.name, None)
+        url = self.kube_client._build_url('{0}/{1}'.format(self.pods_path, executor.name))
+        await self.kube_client._request('DELETE', url, function_name=pool.function_name)
+
+    async def reconcile(self):
+        '''Resizes the pools to their load'''
+        now = time.time()
+        elapsed = max(now - self._last_reconcile, 1e-3)
+        self._last_reconcile = now
+        requests = []
+        for function_name, pool in list(self._pools.items()):
+            desired = self._get_desired_size(pool, elapsed)
+            current = [e for e in pool.executors.values() if e.version == pool.version]
+            # Replace the executors of previous deployment versions once idle
+            removable = [e for e in pool.executors.values() if e.version != pool.version and not e.busy]
+            idle = [e for e in current if not e.busy]
+            removable += idle[:max(0, len(current) - desired)]
+            for executor in removable:
+                requests.append(self._delete_executor(pool, executor))
+            for _ in range(desired - len(current)):
+                requests.append(self._create_executor(pool))
+            if desired != len(current):
+                logging.info('Resizing warm pool of function {0} from {1} to {2} executors'.format(
+                    function_name, len(current), desired))
+            metrics.WARM_POOL_SIZE.set(desired, function_name)
+            if not desired and not pool.executors:
+                del self._pools[function_name]
+        await asyncio.gather(*requests)
+
+    def _update_executor(self, pod):
+        labels = pod['metadata'].get('labels') or {}
+        if labels.get(OWNER_LABEL) != self.owner:
+            return
+        pool = self._get_pool(labels[POOL_LABEL])
+        name = pod['metadata']['name']
+        executor = pool.executors.get(name)
+        if executor is None:
+            executor = pool.executors[name] = Executor(name, labels.get(VERSION_LABEL))
+        executor.ip = pod.get('status', {}).get('podIP')
+        executor.ready = bool(executor.ip) and is_pod_ready(pod)
+        if pod.get('status', {}).get('phase') == 'Failed':
+            # Replaced on the next reconciliation
+            executor.version = None
+
+    def resync(self, items):
+        for pool in self._pools.values():
+            pool.executors.clear()
+        for pod in items:
+            self._update_executor(pod)
+
+    def update(self, event_type, obj):
+        if event_type == 'DELETED':
+            labels = obj['metadata'].get('labels') or {}
+            pool = self._pools.get(labels.get(POOL_LABEL))
+            if pool:
+                pool.executors.pop(obj['metadata']['name'], None)
+        elif event_type in ('ADDED', 'MODIFIED'):
+            self._update_executor(obj)
+
+    async def _owner_pod_exists(self, pod_name):
+        # Single request, unreachable servers count as existing
+        url = self.kube_client._build_url('/api/v1/namespaces/{0}/pods/{1}'.format(self.owner_pod_namespace,
+                                                                                   pod_name))
+        status, _, _ = await self.kube_client._send_request('GET', url, None, None, None, '')
+        return status != 404
+
+    async def collect_orphans(self):
+        '''Deletes the executors without a live owner process'''
+        url = self.kube_client._build_url('{0}?labelSelector={1}'.format(self.pods_path, OWNER_POD_LABEL))
+        pods = await self.kube_client._create_request('GET', url)
+        if not pods:
+            return
+        # Executors of each worker pod
+        executors = {}
+        for pod in pods['items']:
+            labels = pod['metadata'].get('labels') or {}
+            executors.setdefault(labels[OWNER_POD_LABEL], []).append(pod)
+        live_owners = set(get_owner(self.owner_pod, index) for index in range(self.worker_count))
+        requests = []
+        for owner_pod, pods in executors.items():
+            if owner_pod == self.owner_pod:
+                pods = [pod for pod in pods if pod['metadata']['labels'].get(OWNER_LABEL) not in live_owners]
+            elif await self._owner_pod_exists(owner_pod):
+                continue
+            for pod in pods:
+                logging.info('Deleting executor {0} of worker pod {1}'.format(pod['metadata']['name'], owner_pod))
+                url = self.kube_client._build_url('{0}/{1}'.format(self.pods_path, pod['metadata']['name']))
+                requests.append(self.kube_client._request('DELETE', url))
+        await asyncio.gather(*requests)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+                if self.owner_pod_namespace and time.time() - self._last_orphan_check >= self.orphan_interval:
+                    self._last_orphan_check = time.time()
+                    await self.collect_orphans()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.error('Error resizing warm pools: {0}'.format(str(ex)))
+
+    async def close(self):
+        # Executors are not left running after a graceful shutdown
+        requests = []
+        for pool in self._pools.values():
+            for executor in list(pool.executors.values()):
+                requests.append(self._delete_executor(pool, executor))
+        await asyncio.gather(*requests, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
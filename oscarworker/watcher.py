@@ -0,0 +1,112 @@
+# OSCAR - On-premises Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import logging
+from urllib.parse import urlencode
+
+
+class ResourceWatcher:
+    '''Keeps handlers in sync with a Kubernetes collection by listing it once
+    and then following a WATCH from the returned resourceVersion.
+
+    Handlers must implement resync(items) and update(event_type, obj).'''
+
+    list_page_size = 500
+    watch_timeout_seconds = 300
+    retry_delay = 5
+
+    def __init__(self, kube_client, path, label_selector=None, field_selector=None):
+        self.kube_client = kube_client
+        self.path = path
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.resource_version = None
+        self.handlers = []
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def _build_query(self, params):
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+        if self.field_selector:
+            params['fieldSelector'] = self.field_selector
+        return urlencode(params)
+
+    async def list(self):
+        items = []
+        continue_token = None
+        while True:
+            params = {'limit': self.list_page_size}
+            if continue_token:
+                params['continue'] = continue_token
+            url = self.kube_client._build_url('{0}?{1}'.format(self.path, self._build_query(params)))
+            resp = await self.kube_client._create_request('GET', url)
+            if not resp:
+                logging.error('Error listing {0}'.format(self.path))
+                return False
+            items.extend(resp.get('items') or [])
+            continue_token = resp['metadata'].get('continue')
+            if not continue_token:
+                self.resource_version = resp['metadata']['resourceVersion']
+                break
+        for handler in self.handlers:
+            handler.resync(items)
+        return True
+
+    def _process_event(self, event):
+        event_type = event['type']
+        obj = event['object']
+        if event_type == 'ERROR':
+            # 410 Gone: the resourceVersion is too old, a new LIST is needed
+            logging.warning('Watch on {0} expired: {1}'.format(self.path, obj.get('message')))
+            self.resource_version = None
+            return False
+        self.resource_version = obj['metadata']['resourceVersion']
+        if event_type != 'BOOKMARK':
+            for handler in self.handlers:
+                handler.update(event_type, obj)
+        return True
+
+    async def watch(self):
+        params = {'watch': 1,
+                  'resourceVersion': self.resource_version,
+                  'allowWatchBookmarks': 'true',
+                  'timeoutSeconds': self.watch_timeout_seconds}
+        url = self.kube_client._build_url('{0}?{1}'.format(self.path, self._build_query(params)))
+        await self.kube_client._watch_request(url, lambda line: self._process_event(json.loads(line.decode('utf-8'))))
+
+    async def run(self):
+        while True:
+            try:
+                if self.resource_version is None and not await self.list():
+                    await asyncio.sleep(self.retry_delay)
+                    continue
+                await self.watch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.error('Error watching {0}: {1}'.format(self.path, str(ex)))
+                await asyncio.sleep(self.retry_delay)
+
+
+class WatchHandler:
+    '''Adapts a pair of callables to the ResourceWatcher handler interface'''
+
+    def __init__(self, resync, update):
+        self.resync = resync
+        self.update = update
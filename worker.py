@@ -14,41 +14,93 @@
 # limitations under the License.
 
 import asyncio
+import math
+import os
 import signal
 import logging
+import time
+import oscarworker.utils as utils
 from oscarworker.kubernetesclient import KubernetesClient
-from oscarworker.subscribers.nats import NatsSubscriber
+from oscarworker.metrics import MetricsServer, MetricsAggregator
+from oscarworker.scheduler import FairScheduler
+from oscarworker.subscribers.local import LocalSubscriber
+from oscarworker.subscribers.nats import NatsSubscriber, NatsPullSubscriber
 
 loglevel = logging.INFO
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(format=FORMAT, level=loglevel)
 
-def main():
+# Subscriber backends
+SUBSCRIBERS = {
+    'nats': NatsSubscriber,
+    'nats-pull': NatsPullSubscriber,
+    'local': LocalSubscriber
+}
+
+def run_worker():
     logging.info('Starting OSCAR Worker...')
 
     kube_client = KubernetesClient()
     loop = asyncio.get_event_loop()
 
-    # Set signal handler
+    # Serve Prometheus metrics and probes (disabled if METRICS_PORT is 0)
+    metrics_port = get_metrics_port()
+    if int(metrics_port) and utils.get_environment_variable('WORKER_COUNT'):
+        # Supervised workers use the following ports, METRICS_PORT serves
+        # the metrics of all of them
+        metrics_port = int(metrics_port) + 1 + int(utils.get_environment_variable('WORKER_INDEX') or 0)
+    metrics_server = MetricsServer(int(metrics_port), readiness=lambda: kube_client.ready)
+    if int(metrics_port):
+        loop.run_until_complete(metrics_server.start())
+
+    # Set signal handler (before warming up, which may take a while)
     for sig in (signal.SIGINT, signal.SIGTERM):
         loop.add_signal_handler(sig, ask_exit)
 
-    # Subscribers list (Currently only nats)
+    # Warm up caches and connections and start background watchers before
+    # subscribing, so the first event is processed as fast as the rest
+    try:
+        loop.run_until_complete(kube_client.start())
+    except asyncio.CancelledError:
+        # Terminated while warming up
+        loop.run_forever()
+        close_worker(loop, metrics_server, kube_client)
+        return
+
+    # Launch the events of each function from its own queue, sharing the
+    # launch slots fairly (disabled if SCHEDULER_CONCURRENCY is 0)
+    scheduler_concurrency = utils.get_environment_variable('SCHEDULER_CONCURRENCY')
+    if not scheduler_concurrency:
+        scheduler_concurrency = 64
+    handler = kube_client.launch_job
+    batch_handler = kube_client.launch_jobs
+    if int(scheduler_concurrency):
+        scheduler = FairScheduler(kube_client.launch_job, int(scheduler_concurrency),
+                                  kube_client.get_scheduling_settings)
+        handler = scheduler.submit
+        batch_handler = scheduler.submit_batch
+
+    # Subscribers list: 'nats' (default), 'nats-pull' or 'local'
     subscribers = []
-    nats_client = NatsSubscriber()
-    subscribers.append(nats_client)
-    
+    for name in (utils.get_environment_variable('SUBSCRIBER') or 'nats').split(','):
+        subscribers.append(SUBSCRIBERS[name.strip()]())
+
     # Asyncio tasks list
     tasks = []
     for subscriber in subscribers:
-        #task = asyncio.create_task(subscriber.run(loop, kube_client.launch_job)) # Only works in Python 3.7+
-        task = asyncio.ensure_future(subscriber.run(loop, kube_client.launch_job))
+        #task = asyncio.create_task(subscriber.run(loop, handler, batch_handler)) # Only works in Python 3.7+
+        task = asyncio.ensure_future(subscriber.run(loop, handler, batch_handler))
         tasks.append(task)
 
     # Run tasks
     loop.run_until_complete(asyncio.wait(tasks))
     loop.run_forever()
 
+    close_worker(loop, metrics_server, kube_client)
+
+def close_worker(loop, metrics_server, kube_client):
+    loop.run_until_complete(metrics_server.close())
+    loop.run_until_complete(kube_client.close())
     loop.close()
     logging.info('Closed.')
 
@@ -65,6 +117,139 @@ def ask_exit():
         task.cancel()
     asyncio.ensure_future(exit())
 
+def get_metrics_port():
+    metrics_port = utils.get_environment_variable('METRICS_PORT')
+    if not metrics_port:
+        metrics_port = 8080
+    return int(metrics_port)
+
+def read_cgroup_value(*paths):
+    # First readable value of the cgroup (v2 or v1) files, None if unlimited
+    for path in paths:
+        try:
+            value = utils.read_file(path).split()
+        except OSError:
+            continue
+        if value and value[0] not in ('max', '-1'):
+            return value
+        return None
+    return None
+
+def get_cpu_count():
+    # CPUs available to this process (may be restricted by its affinity)
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    # CPU limit of the container
+    quota = read_cgroup_value('/sys/fs/cgroup/cpu.max', '/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    if quota is not None:
+        if len(quota) > 1:
+            period = quota[1]
+        else:
+            period = utils.read_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        cpus = min(cpus, math.ceil(int(quota[0]) / int(period)))
+    return max(1, cpus)
+
+def get_process_count():
+    # One process per CPU, as long as they fit in the memory limit of the container
+    processes = get_cpu_count()
+    memory_limit = read_cgroup_value('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if memory_limit is not None:
+        process_memory = utils.get_environment_variable('WORKER_PROCESS_MEMORY')
+        if not process_memory:
+            process_memory = '128Mi'
+        processes = min(processes, int(int(memory_limit[0]) // utils.parse_quantity(process_memory)))
+    return max(1, processes)
+
+def spawn_metrics_aggregator(processes):
+    pid = os.fork()
+    if pid == 0:
+        # Do not inherit the signal handlers of the supervisor
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+        metrics_port = get_metrics_port()
+        aggregator = MetricsAggregator(metrics_port, [metrics_port + 1 + index for index in range(processes)])
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, loop.stop)
+        try:
+            loop.run_until_complete(aggregator.start())
+            loop.run_forever()
+            loop.run_until_complete(aggregator.close())
+        finally:
+            os._exit(0)
+    logging.info('Started metrics process (pid {0})'.format(pid))
+    return pid
+
+def spawn_worker(index, processes):
+    pid = os.fork()
+    if pid == 0:
+        # Do not inherit the signal handlers of the supervisor
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+        # Child process: identify it for the components that are sharded
+        utils.set_environment_variable('WORKER_INDEX', str(index))
+        utils.set_environment_variable('WORKER_COUNT', str(processes))
+        try:
+            run_worker()
+        finally:
+            os._exit(0)
+    logging.info('Started worker process {0} (pid {1})'.format(index, pid))
+    return pid
+
+def supervise(processes):
+    logging.info('Starting OSCAR Worker supervisor with {0} processes...'.format(processes))
+    children = {}
+    for index in range(processes):
+        children[spawn_worker(index, processes)] = index
+    # Metrics and readiness of all the workers (index -1)
+    if get_metrics_port():
+        children[spawn_metrics_aggregator(processes)] = -1
+
+    stopping = []
+
+    # Forward termination signals so every worker shuts down gracefully
+    def handle_signal(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, handle_signal)
+
+    while children:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        if stopping:
+            logging.info('Worker process {0} finished'.format(index))
+        elif index < 0:
+            logging.error('Metrics process exited with status {0}, restarting it'.format(status))
+            time.sleep(1)
+            children[spawn_metrics_aggregator(processes)] = index
+        else:
+            # Replace workers that exit unexpectedly
+            logging.error('Worker process {0} exited with status {1}, restarting it'.format(index, status))
+            time.sleep(1)
+            children[spawn_worker(index, processes)] = index
+    logging.info('Closed.')
+
+def main():
+    # Number of worker processes (defaults to the number of CPUs of the
+    # container that fit in its memory limit)
+    processes = utils.get_environment_variable('WORKER_PROCESSES')
+    if not processes:
+        processes = get_process_count()
+    if int(processes) > 1:
+        supervise(int(processes))
+    else:
+        run_worker()
+
 
 if __name__ == "__main__":
     main()